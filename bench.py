@@ -0,0 +1,4 @@
+#!/usr/bin/env python
+import sys
+import enduroape.bench
+sys.exit(enduroape.bench.main(sys.argv[1:]))
@@ -0,0 +1,322 @@
+# -*- coding: utf-8 -*-
+#
+# Benchmark do processamento das planilhas, usando planilhas sintéticas
+#
+
+import sys, os, time, random, optparse, tempfile, shutil, wave, json, glob, platform
+
+from enduroape.trilhape import planilha
+import enduroape.sound
+
+import logging
+logger = logging.getLogger('enduroape.bench')
+dbg = logger.debug
+info = logger.info
+
+
+PAGE_WIDTH = 64 # largura de cada página na saída do 'pdftotext -layout'
+
+REFS_PER_PAGE = 8
+
+DESCRIPTIONS = [u'Siga em frente pela trilha', u'Vire a esquerda na porteira',
+                u'Cuidado com o barranco', u'Passe a ponte sobre o rio',
+                u'Siga pela estrada', u'Desça com cuidado, piso liso',
+                u'Entre no mato a direita', u'Contorne o tanque']
+
+TRECHO_GAP = 30 # segundos entre o fim de um trecho e a largada do próximo
+
+# distâncias entre referências, em metros. As planilhas de 1000 páginas
+# precisam terminar antes de 100 horas (o formato do tempo é HH:MM:SS)
+MIN_DIST = 5
+MAX_DIST = 40
+
+SIZES = [10, 100, 1000]
+
+SOUND_PAGES = 10 # o som de planilhas maiores tem várias horas
+
+# palavras usadas pelo gerador de som
+SOUND_WORDS = ['trecholongo', 'distanciaparaproxima', 'distancia', 'metros', 'passos',
+               'referencia', 'neutrode', 'minutos', 'segundos', '10-segundos-neutro',
+               'neutro-acabou', 'novo-trecho', 'metros-por-segundo', 'nova-pagina']
+
+def sheet_pages(npages, seed=1):
+    """Generate the lines of each page of a synthetic sheet
+
+    The pages have the same structure of the real ones: header,
+    TRECHO and Velocidade Média lines, references with the relative
+    distance, time, absolute distance and observations, and
+    NEUTRALIZADO blocks.
+    """
+    r = random.Random(seed)
+    t = 0
+    trecho = 0
+    abs_dist = 0
+    speed = 40
+    for n in xrange(1, npages+1):
+        lines = [u'', u'                    TRILHA PÉ AVENTURA', u'',
+                 u'Distância Referência                    Observações', u'']
+        if n == 1 or r.random() < 0.3:
+            if trecho:
+                # the largada of a new trecho is a new time, as on the real sheets
+                t += TRECHO_GAP
+            trecho += 1
+            speed = r.choice([30, 40, 45, 50])
+            abs_dist = 0
+            lines += [u'          TRECHO %d' % (trecho),
+                      u'          Velocidade Média %d m/min' % (speed),
+                      u'   000    Largada do trecho',
+                      planilha.format_time(t),
+                      u'   000']
+        for k in xrange(REFS_PER_PAGE):
+            d = r.randint(MIN_DIST, MAX_DIST)
+            t += int(round(d*60.0/speed))
+            if abs_dist+d > 999:
+                abs_dist = 0
+            abs_dist += d
+            lines.append(u'   %03d    %s' % (d, r.choice(DESCRIPTIONS)))
+            lines.append(u'%s  %s' % (planilha.format_time(t), r.choice([u'', u'fitas na cerca'])))
+            lines.append(u'   %03d' % (abs_dist))
+            if r.random() < 0.3:
+                lines.append(u'          e depois siga o carreiro')
+        if r.random() < 0.2:
+            minutes = r.randint(1, 3)
+            t += minutes*60
+            lines.append(u'          NEUTRALIZADO DE %d MINUTOS' % (minutes))
+            lines.append(u'          %s' % (planilha.format_time(t)))
+        lines.append(u'')
+        lines.append((u'Página %d' % (n)).rjust(PAGE_WIDTH-6))
+        yield lines
+
+def sheet_dump(npages, seed=1):
+    """Generate the lines of a synthetic 'pdftotext -layout' dump
+
+    Pages are laid out two by two, side by side, with a form feed
+    before each group, as pdftotext does.
+    """
+    pages = list(sheet_pages(npages, seed))
+    first = True
+    for g in xrange(0, len(pages), 2):
+        group = pages[g:g+2]
+        height = max(len(p) for p in group)
+        for i in xrange(height):
+            parts = []
+            for p in group:
+                # the page number goes on the last line
+                if i == height-1:
+                    l = p[-1]
+                elif i < len(p)-1:
+                    l = p[i]
+                else:
+                    l = u''
+                parts.append(l.ljust(PAGE_WIDTH))
+            l = u''.join(parts).rstrip()
+            if i == 0 and not first:
+                l = planilha.FORMFEED+l
+            yield l
+        first = False
+
+def write_wav(fname, samples):
+    w = wave.open(fname, 'wb')
+    w.setnchannels(1)
+    w.setsampwidth(enduroape.sound.BYTES)
+    w.setframerate(enduroape.sound.RATE)
+    w.writeframes('\1\0'*samples)
+    w.close()
+
+def make_sound_bank(dir, nrefs):
+    """Create stub sound files on 'dir', and a stub 'sox' that discards its input"""
+    for d in ['sounds/words', 'sounds/digits', 'instr', 'bin']:
+        os.makedirs(os.path.join(dir, d))
+    write_wav(os.path.join(dir, enduroape.sound.CLICK_FILE), 1000)
+    for w in SOUND_WORDS:
+        write_wav(os.path.join(dir, 'sounds/words/%s.wav' % (w)), 10000)
+    for d in xrange(10):
+        write_wav(os.path.join(dir, 'sounds/digits/%d.wav' % (d)), 8000)
+    for n in xrange(1, nrefs+1):
+        write_wav(os.path.join(dir, 'instr/ref%d.wav' % (n)), 40000)
+
+    sox = os.path.join(dir, 'bin', 'sox')
+    f = open(sox, 'w')
+    f.write('#!/bin/sh\ncat > /dev/null\n')
+    f.close()
+    os.chmod(sox, 0755)
+
+class Options:
+    """The planilha.main() options used by the benchmark"""
+    parciais = True
+    estrategia_parciais = planilha.ESTRATEGIA_PADRAO
+    pdf_extractor = 'pdftotext'
+    no_silence = False
+    instructions_dir = 'instr'
+    audio_engine = 'sox'
+    jobs = 1
+    sound_cache = None
+    sound_cache_max_size = enduroape.sound.SEGMENT_CACHE_MAX_MB
+    sound_cache_max_age = enduroape.sound.SEGMENT_CACHE_MAX_DAYS
+    timeline = False
+    soundfile = 'bench.wav'
+
+class ErrorLog(logging.Handler):
+    """Keeps the messages logged with level ERROR or above"""
+    def __init__(self):
+        logging.Handler.__init__(self, logging.ERROR)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+def timed(results, name, f, *args):
+    start = time.time()
+    r = f(*args)
+    results[name] = time.time()-start
+    info('%s: %.3fs', name, results[name])
+    return r
+
+def split_pages(lines):
+    groups = list(planilha.split_groups(lines))
+    for g in groups:
+        g.find_width()
+        g.find_page_limits()
+    return [p for g in groups for p in g.pages]
+
+def bench_sheet(npages, templates, sound=False):
+    """Time each stage of the pipeline over a synthetic sheet
+
+    Each stage runs on a fresh copy of the pages, because parsing
+    changes them. Errors logged while running (e.g. by the parser)
+    make the benchmark fail: the synthetic sheets must be valid, so
+    the normal parse path is measured.
+    """
+    r = {}
+    opts = Options()
+    lines = list(sheet_dump(npages))
+
+    errors = ErrorLog()
+    logging.getLogger().addHandler(errors)
+    try:
+        _bench_sheet(r, opts, lines, templates, sound)
+    finally:
+        logging.getLogger().removeHandler(errors)
+    if errors.messages:
+        raise Exception('%d erros na planilha sintética de %d páginas, o primeiro: %s' % (len(errors.messages), npages, errors.messages[0]))
+    return r
+
+def _bench_sheet(r, opts, lines, templates, sound):
+    groups = timed(r, 'split_groups', list, planilha.split_groups(lines))
+    def limits():
+        for g in groups:
+            g.find_width()
+            g.find_page_limits()
+    timed(r, 'find_page_limits', limits)
+
+    pages = [p for g in groups for p in g.pages if not p.number.startswith('A')]
+    def parse_sheet():
+        for p in pages:
+            for i in p.parse_sheet():
+                pass
+    timed(r, 'parse_sheet', parse_sheet)
+
+    items = timed(r, 'parse_pages', list, planilha.parse_pages(opts, split_pages(lines)))
+
+    out = open(os.devnull, 'w')
+    timed(r, 'format_text', planilha.format_text, items, out)
+    timed(r, 'format_html', planilha.format_html, items, out)
+    for t in templates:
+        name = 'template:%s' % (os.path.splitext(os.path.basename(t))[0])
+        timed(r, name, planilha.format_template, opts, items, out, t)
+    out.close()
+
+    if sound:
+        r.update(bench_sound(opts, items))
+
+def bench_sound(opts, items):
+    """Time the soundtrack generation, with stub sound files and sox"""
+    r = {}
+    nrefs = len([i for s,i in items if i.is_a('Referencia')])
+    olddir = os.getcwd()
+    oldpath = os.environ.get('PATH', '')
+    dir = tempfile.mkdtemp()
+    try:
+        make_sound_bank(dir, nrefs)
+        os.chdir(dir)
+        os.environ['PATH'] = os.path.join(dir, 'bin')+os.pathsep+oldpath
+        for engine in sorted(enduroape.sound.ENGINES):
+            opts.audio_engine = engine
+            enduroape.sound.sample_cache.clear()
+            timed(r, 'sound:%s' % (engine), enduroape.sound.generate_soundtrack, opts, items)
+    finally:
+        os.environ['PATH'] = oldpath
+        os.chdir(olddir)
+        shutil.rmtree(dir)
+    return r
+
+def loadable_templates(templates):
+    """The templates that compile on this tree
+
+    The others (e.g. importing modules that are not here) are skipped
+    with a warning. Errors while running a template fail the benchmark.
+    """
+    r = []
+    for t in templates:
+        try:
+            planilha.template_loader.get(t)
+        except Exception, e:
+            logger.warn('template %s ignorado, não compila: %s', t, e)
+            continue
+        r.append(t)
+    return r
+
+def run(sizes, templates, sound_pages=SOUND_PAGES, repeat=1):
+    """Run the benchmark for each sheet size. The best time of 'repeat' runs is kept"""
+    results = {}
+    for n in sizes:
+        best = {}
+        for k in xrange(repeat):
+            for name,t in bench_sheet(n, templates, n <= sound_pages).items():
+                if name not in best or t < best[name]:
+                    best[name] = t
+        results[str(n)] = best
+    return results
+
+def main(argv):
+    parser = optparse.OptionParser(usage='%prog [opções]')
+    parser.add_option('--pages', help=u"Tamanhos das planilhas, em páginas (padrão: %s)" % (','.join(map(str, SIZES))), action='store', dest='pages', default=','.join(map(str, SIZES)))
+    parser.add_option('--sound-pages', help=u"Gera o som só para planilhas de até N páginas (padrão: %d)" % (SOUND_PAGES), metavar='N', type='int', action='store', dest='sound_pages', default=SOUND_PAGES)
+    parser.add_option('-r', '--repeat', help=u"Número de repetições, o melhor tempo é mantido", type='int', action='store', dest='repeat', default=1)
+    parser.add_option('-o', help=u"Arquivo JSON para gravar os resultados", metavar='ARQUIVO.JSON', action='store', dest='output')
+    parser.add_option('--templates', help=u"Templates Cheetah a medir (padrão: templates/*.tmpl)", action='store', dest='templates', default='templates/*.tmpl')
+    parser.add_option('-v', help=u"Verbose mode", action='store_true', dest='verbose')
+
+    opts,args = parser.parse_args(argv)
+    if args:
+        parser.error(u"argumentos inesperados: %r" % (args))
+
+    loglevel = logging.WARN
+    if opts.verbose:
+        loglevel = logging.INFO
+    logging.basicConfig(stream=sys.stderr, level=loglevel)
+
+    sizes = [int(n) for n in opts.pages.split(',')]
+    templates = loadable_templates(sorted(glob.glob(opts.templates)))
+    results = run(sizes, templates, opts.sound_pages, opts.repeat)
+
+    data = {
+        'python': platform.python_version(),
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'repeat': opts.repeat,
+        'results': results,
+    }
+    if opts.output:
+        f = open(opts.output, 'w')
+        json.dump(data, f, indent=2, sort_keys=True)
+        f.close()
+
+    for n in sizes:
+        print '%d páginas:' % (n)
+        for name,t in sorted(results[str(n)].items()):
+            print '  %-24s %8.3fs' % (name, t)
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
+
+# vim: et ts=4 sw=4:
@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+#
+# Servidor que transmite os avisos da prova para os aparelhos da
+# equipe (--cue-server), em vez de cada um levar o seu WAV
+#
+
+import time, socket, select, errno, heapq, json
+
+import logging
+logger = logging.getLogger('enduroape.cues')
+dbg = logger.debug
+info = logger.info
+warn = logger.warn
+
+
+CUE_PORT = 7373
+
+NEUTRO_AVISO = 10 # segundos antes do fim do neutro, como no som
+
+MAX_BACKLOG = 64*1024 # bytes pendentes; clientes mais lentos que isso são desconectados
+
+DRAIN_TIMEOUT = 10 # segundos para enviar os últimos avisos aos clientes lentos, no fim
+
+def circuit_cues(items):
+    """Generate the (race time, cue) pairs of the circuit
+
+    The cues are the same events of the soundtrack: new trecho, new
+    page, references, partials and the neutral countdown. Each cue is
+    a dict with the 'cue' name, the race time 't' and its data.
+
+    On neutrals shorter than NEUTRO_AVISO the 10s warning is skipped.
+    The soundtrack logs the same warning, but still plays it late.
+    """
+    for s,i in items:
+        if i.is_a('Referencia'):
+            yield i.abs_time, dict(cue='referencia', t=i.abs_time, ref=i.ref_id,
+                                   passos=i.rel_passos, metros=i.rel_dist)
+        elif i.is_a('Parcial'):
+            yield i.abs_time, dict(cue='parcial', t=i.abs_time, ref=i.ref_id,
+                                   passos=i.rel_passos, metros=i.rel_dist)
+        elif i.is_a('Neutro'):
+            start = s.prev_abs_time
+            yield start, dict(cue='neutro', t=start, ref=i.ref_id, segundos=i.abs_time-start)
+            aviso = i.abs_time-NEUTRO_AVISO
+            if aviso < start:
+                # neutro curto: o aviso viria antes do próprio neutro
+                warn("Sem tempo para avisar do fim do neutro! (-10s)")
+            else:
+                yield aviso, dict(cue='10-segundos-neutro', t=aviso, ref=i.ref_id)
+            yield i.abs_time, dict(cue='neutro-acabou', t=i.abs_time, ref=i.ref_id)
+        elif i.is_a('NovoTrecho'):
+            yield s.abs_time, dict(cue='novo-trecho', t=s.abs_time, trecho=i.number,
+                                   velocidade=i.speed, bpm=i.steps_bpm)
+        elif i.is_a('NewPage'):
+            yield s.abs_time, dict(cue='nova-pagina', t=s.abs_time, pagina=i.number)
+
+class Client:
+    def __init__(self, sock, addr):
+        self.sock = sock
+        self.addr = addr
+        self.pending = []
+        self.pending_bytes = 0
+
+    def push(self, data):
+        self.pending.append(data)
+        self.pending_bytes += len(data)
+
+    def flush(self):
+        """Send what the socket accepts now. Returns False if the connection is lost"""
+        if not self.pending:
+            return True
+        data = ''.join(self.pending)
+        try:
+            n = self.sock.send(data)
+        except socket.error, e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                n = 0
+            else:
+                return False
+        data = data[n:]
+        self.pending = data and [data] or []
+        self.pending_bytes = len(data)
+        return True
+
+class CueServer:
+    """Send each cue, at its time, to all the connected clients
+
+    Single-threaded: one heap of cues, ordered by wall time, serves all
+    the connections, and the select() loop sleeps until the next cue or
+    network event. Each cue is encoded once, as a JSON line, and queued
+    to all the clients; the clients that can't keep up are dropped.
+
+    New clients get a 'hello' line with the current race time.
+    'clock' returns the current time (time.time() by default) and can
+    be replaced to run on simulated time. 'listener' is a socket
+    already returned by listen(); otherwise one is bound to 'address'.
+    """
+    def __init__(self, cues, start, address=('', CUE_PORT), clock=None, listener=None):
+        self.start = start
+        self.clock = clock or time.time
+        self.heap = []
+        for seq,(t,cue) in enumerate(cues):
+            self.heap.append( (start+t, seq, cue) )
+        heapq.heapify(self.heap)
+        self.sent = 0
+
+        self.listener = listener or listen(address)
+        self.clients = {}
+
+    @property
+    def address(self):
+        return self.listener.getsockname()
+
+    def line(self, cue):
+        return json.dumps(cue, sort_keys=True)+'\n'
+
+    def accept(self):
+        while True:
+            try:
+                sock,addr = self.listener.accept()
+            except socket.error, e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            sock.setblocking(0)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            c = self.clients[sock] = Client(sock, addr)
+            dbg('client %s:%d connected', *addr)
+            c.push(self.line(dict(cue='hello', t=self.clock()-self.start, cues=len(self.heap))))
+            self.flush(c)
+
+    def drop(self, c):
+        dbg('client %s:%d disconnected', *c.addr)
+        del self.clients[c.sock]
+        c.sock.close()
+
+    def flush(self, c):
+        if not c.flush():
+            self.drop(c)
+        elif c.pending_bytes > MAX_BACKLOG:
+            warn('client %s:%d too slow, disconnecting', *c.addr)
+            self.drop(c)
+
+    def send_due(self, now):
+        """Send the cues due at 'now'. Returns the number of cues sent"""
+        n = 0
+        while self.heap and self.heap[0][0] <= now:
+            due,seq,cue = heapq.heappop(self.heap)
+            data = self.line(cue)
+            for c in self.clients.values():
+                c.push(data)
+            n += 1
+        if n:
+            for c in self.clients.values():
+                self.flush(c)
+            self.sent += n
+        return n
+
+    def poll(self, timeout):
+        """Wait up to 'timeout' seconds (None: forever) for network events and handle them"""
+        rlist = [self.listener]+self.clients.keys()
+        wlist = [c.sock for c in self.clients.values() if c.pending]
+        try:
+            r,w,x = select.select(rlist, wlist, [], timeout)
+        except select.error, e:
+            if e.args[0] == errno.EINTR:
+                return
+            raise
+
+        for sock in r:
+            if sock is self.listener:
+                self.accept()
+                continue
+            c = self.clients.get(sock)
+            if c is None:
+                continue
+            try:
+                data = sock.recv(4096)
+            except socket.error:
+                data = ''
+            # the clients don't send anything, only the disconnection matters
+            if not data:
+                self.drop(c)
+        for sock in w:
+            c = self.clients.get(sock)
+            if c is not None:
+                self.flush(c)
+
+    def step(self, max_wait=None):
+        """Send the due cues, then wait for the next cue or a network event
+
+        Returns False when there are no more cues.
+        """
+        self.send_due(self.clock())
+        if not self.heap:
+            return False
+        timeout = max(self.heap[0][0]-self.clock(), 0)
+        if max_wait is not None:
+            timeout = min(timeout, max_wait)
+        self.poll(timeout)
+        return True
+
+    def run(self):
+        info('cue server on %s:%d, %d cues', self.address[0], self.address[1], len(self.heap))
+        try:
+            while self.step():
+                pass
+            # the last cues are still on the buffers of the slow clients
+            deadline = self.clock()+DRAIN_TIMEOUT
+            while any(c.pending for c in self.clients.values()):
+                now = self.clock()
+                if now >= deadline:
+                    for c in self.clients.values():
+                        if c.pending:
+                            warn('client %s:%d not reading, dropping %d bytes', c.addr[0], c.addr[1], c.pending_bytes)
+                            self.drop(c)
+                    break
+                self.poll(min(deadline-now, 1.0))
+        finally:
+            self.close()
+
+    def close(self):
+        for c in self.clients.values():
+            c.sock.close()
+        self.clients = {}
+        self.listener.close()
+
+def listen(address):
+    """Bind the listening socket to 'address'. Raises socket.error if the port is busy"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(address)
+        sock.listen(socket.SOMAXCONN)
+    except socket.error:
+        sock.close()
+        raise
+    sock.setblocking(0)
+    return sock
+
+def parse_address(s):
+    """'[HOST:]PORT' -> (host, port). The default host is all the interfaces"""
+    host,sep,port = s.rpartition(':')
+    return host, int(port)
+
+def run_server(opts, items, start, listener, out=None):
+    """The cue server output
+
+    'start' is the start time, as returned by ticker.parse_start(), and
+    'listener' the socket returned by listen(), bound before the sheet
+    is parsed so a busy port is reported right away.
+    """
+    CueServer(circuit_cues(items), start, listener=listener).run()
+
+# vim: et ts=4 sw=4:
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+#
+# Medição de tempo e memória de cada etapa do processamento (--profile)
+#
+
+import os, time, resource, collections
+
+import logging
+logger = logging.getLogger('enduroape.perf')
+dbg = logger.debug
+
+
+# Profiler ativo, ou None. As funções wrap(), call() e count() não
+# fazem nada quando não há profiler ativo.
+current = None
+
+def cpu_time():
+    t = os.times()
+    return t[0]+t[1]
+
+def max_rss():
+    """Peak memory use of the process, in KB"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+class Stage:
+    def __init__(self, name):
+        self.name = name
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.calls = 0
+        self.items = 0
+        self.rss = 0 # aumento do pico de memória, em KB
+        self.cprofile = None
+
+    def as_dict(self):
+        return dict(wall=self.wall, cpu=self.cpu, calls=self.calls, items=self.items, rss_kb=self.rss)
+
+class Profiler:
+    """Wall time, CPU time, item count and memory growth of each stage
+
+    The stages are nested (e.g. the parser pulls lines from the
+    extraction stage), so the time of a stage doesn't include the time
+    of the stages it calls. Not thread-safe: all the stages must run
+    on the same thread.
+
+    'clock' returns the wall time (time.time() by default) and can be
+    replaced to run on simulated time.
+    """
+    def __init__(self, cprofile=False, clock=None):
+        self.stages = collections.OrderedDict()
+        self.counters = collections.OrderedDict()
+        self.stack = []
+        self.use_cprofile = cprofile
+        self.clock = clock or time.time
+        self.start = self.clock()
+
+    def stage(self, name):
+        s = self.stages.get(name)
+        if s is None:
+            s = self.stages[name] = Stage(name)
+            if self.use_cprofile:
+                import cProfile
+                s.cprofile = cProfile.Profile()
+        return s
+
+    def enter(self, name):
+        s = self.stage(name)
+        if self.stack and self.stack[-1][0].cprofile:
+            self.stack[-1][0].cprofile.disable()
+        s.calls += 1
+        self.stack.append( (s, self.clock(), cpu_time(), max_rss()) )
+        if s.cprofile:
+            s.cprofile.enable()
+
+    def exit(self):
+        s,wall,cpu,rss = self.stack.pop()
+        if s.cprofile:
+            s.cprofile.disable()
+        wall = self.clock()-wall
+        cpu = cpu_time()-cpu
+        rss = max_rss()-rss
+        s.wall += wall
+        s.cpu += cpu
+        s.rss += rss
+        if self.stack:
+            # the parent stage was waiting for this one
+            parent = self.stack[-1][0]
+            parent.wall -= wall
+            parent.cpu -= cpu
+            parent.rss -= rss
+            if parent.cprofile:
+                parent.cprofile.enable()
+
+    def wrap(self, name, iterable):
+        it = iter(iterable)
+        s = self.stage(name)
+        while True:
+            self.enter(name)
+            try:
+                i = it.next()
+            except StopIteration:
+                return
+            finally:
+                self.exit()
+            s.items += 1
+            yield i
+
+    def call(self, name, f, *args, **kwargs):
+        self.enter(name)
+        try:
+            return f(*args, **kwargs)
+        finally:
+            self.exit()
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0)+n
+
+    def as_dict(self):
+        return dict(wall=self.clock()-self.start, max_rss_kb=max_rss(),
+                    stages=collections.OrderedDict((s.name, s.as_dict()) for s in self.stages.values()),
+                    counters=self.counters)
+
+    def report(self, out):
+        out.write('%-16s %9s %9s %8s %9s %10s\n' % ('etapa', 'tempo', 'cpu', 'chamadas', 'itens', 'mem (KB)'))
+        for s in self.stages.values():
+            out.write('%-16s %8.3fs %8.3fs %8d %9d %10d\n' % (s.name, s.wall, s.cpu, s.calls, s.items, s.rss))
+        for name,n in self.counters.items():
+            out.write('%-16s %d\n' % (name, n))
+        out.write('total: %.3fs, pico de memória: %d KB\n' % (self.clock()-self.start, max_rss()))
+
+    def dump_cprofile(self, prefix):
+        """Write the cProfile stats of each stage to PREFIX.STAGE.prof"""
+        for s in self.stages.values():
+            if s.cprofile:
+                fname = '%s.%s.prof' % (prefix, s.name.replace(':', '-'))
+                dbg('cProfile stats: %s', fname)
+                s.cprofile.dump_stats(fname)
+
+def wrap(name, iterable):
+    """Count the time spent generating the items of 'iterable' on stage 'name'"""
+    if current is None:
+        return iterable
+    return current.wrap(name, iterable)
+
+def call(name, f, *args, **kwargs):
+    """Call 'f', counting the time on stage 'name'"""
+    if current is None:
+        return f(*args, **kwargs)
+    return current.call(name, f, *args, **kwargs)
+
+def count(name, n=1):
+    """Increment a counter (e.g. subprocesses started)"""
+    if current is not None:
+        current.count(name, n)
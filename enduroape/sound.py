@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 
-import subprocess, sys
+import subprocess, sys, time, wave, collections, array, math, os, tempfile, shutil, itertools, multiprocessing, hashlib, fractions, mmap
+
+import enduroape.perf
 
 import logging
 
@@ -22,15 +24,187 @@ MAX_SAMPLES = 1024*1024 # maximum number of samples handled at once, to avoid al
 
 TRECHO_LONGO = 50
 
-class SoundGenerator:
-    def silence(self, samples):
+SAMPLE_CACHE_BYTES = 64*1024*1024 # limite de memória para o cache de sons decodificados
+
+CLICK_FILE = 'sounds/click.wav'
+
+TIMELINE_MARGIN = 30 # segundos reservados após o último item, para os avisos finais
+
+SEGMENT_CACHE_VERSION = 1 # mude se a geração do som mudar, para invalidar o cache de segmentos
+
+SEGMENT_CACHE_MAX_MB = 1024 # tamanho máximo do cache de segmentos
+SEGMENT_CACHE_MAX_DAYS = 30 # idade máxima dos segmentos no cache
+
+def decode_wav(file):
+    """Decode a WAV file to raw samples, in our raw format
+
+    Uses the 'wave' module if the file is already in the right format,
+    and falls back to sox otherwise.
+    """
+    try:
+        wf = wave.open(file, 'rb')
+    except wave.Error:
+        wf = None
+
+    if wf is not None:
+        try:
+            if wf.getnchannels() == 1 and wf.getsampwidth() == BYTES and wf.getframerate() == RATE:
+                return wf.readframes(wf.getnframes())
+        finally:
+            wf.close()
+
+    dbg('decode_wav: using sox for %r', file)
+    enduroape.perf.count('spawn:sox')
+    proc = subprocess.Popen(['sox', '-t', 'wav', file]+SOX_ARGS+['-'], stdout=subprocess.PIPE)
+    data = proc.stdout.read()
+    proc.wait()
+    if proc.returncode <> 0:
+        raise Exception('sox error')
+    return data
+
+class SampleCache:
+    """Cache of decoded sound files, with LRU eviction
+
+    Each file is decoded only once (while it is on the cache), so
+    repeated words and digits don't need a new sox process.
+    """
+    def __init__(self, max_bytes=SAMPLE_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.entries = collections.OrderedDict()
+
+    def get(self, file):
+        if file in self.entries:
+            self.hits += 1
+            data = self.entries.pop(file)
+            # move it to the end of the LRU list
+            self.entries[file] = data
+            return data
+
+        self.misses += 1
+        data = decode_wav(file)
+        if len(data) <= self.max_bytes:
+            self.entries[file] = data
+            self.bytes += len(data)
+            while self.bytes > self.max_bytes:
+                f,d = self.entries.popitem(last=False)
+                dbg('sample cache: evicting %r', f)
+                self.bytes -= len(d)
+        return data
+
+    def clear(self):
+        self.entries.clear()
+        self.bytes = 0
+
+sample_cache = SampleCache()
+
+class SoxEngine:
+    """Sound synthesis using sox subprocesses"""
+    name = 'sox'
+
+    def silence(self, g, samples):
+        while samples > 0:
+            n = min(samples, MAX_SAMPLES)
+            g.write('\0'*BYTES*n, n)
+            samples -= n
+
+    def sine(self, g, time, freq):
+        return g.sox_effect(['synth', '%.5f' % (time), 'sine', str(freq), 'gain', '-3'])
+
+    def metronome(self, w, bpm, t):
+        beat_length = 60/float(bpm)
+        last_beat = t-beat_length
+
+        beat = MemoryTrack()
+        beat.wav_file(CLICK_FILE)
+
+        now = w.cur_time()
+        while w.cur_time() < last_beat:
+            w.mem_tracks(beat)
+            now += beat_length
+            w.silence_to(now)
+
+class NativeEngine(SoxEngine):
+    """Sound synthesis in Python, without starting sox
+
+    Nothing is copied for the silence and the metronome: they are
+    written as buffer() views of a single preallocated zero buffer and
+    of the cached click. Sine tones repeat one precomputed period.
+    """
+    name = 'native'
+
+    def __init__(self):
+        self.zeros = '\0'*BYTES*MAX_SAMPLES
+
+    def silence(self, g, samples):
         while samples > 0:
             n = min(samples, MAX_SAMPLES)
-            self.write('\0'*BYTES*n, n)
+            g.write(buffer(self.zeros, 0, n*BYTES), n)
             samples -= n
 
+    def sine(self, g, time, freq):
+        """Sine tone, with 'freq' rounded to whole Hz"""
+        samples = int(time*RATE)
+        amp = (2**(BITS-1)-1)*10**(-3/20.0) # gain -3
+        # a whole number of cycles fits in 'period' samples
+        period = RATE/fractions.gcd(RATE, int(round(freq)) or RATE)
+        w = 2*math.pi*freq/RATE
+        cycle = array.array('h', [int(amp*math.sin(w*j)) for j in xrange(period)]).tostring()
+        # enough periods for any block, starting at any phase
+        data = cycle*(min(samples, MAX_SAMPLES)/period+2)
+        k = 0
+        while k < samples:
+            n = min(samples-k, MAX_SAMPLES)
+            g.write(buffer(data, (k%period)*BYTES, n*BYTES), n)
+            k += n
+
+    def metronome(self, w, bpm, t):
+        click = sample_cache.get(CLICK_FILE)
+        click_samples = len(click)/BYTES
+
+        beats,pos = metronome_beats(w, bpm, t, click_samples)
+        for b,next in zip(beats, beats[1:]+[pos]):
+            w.write(click, click_samples)
+            w.silence(next-b-click_samples)
+
+def metronome_beats(w, bpm, t, click_samples):
+    """Calculate the metronome beat positions, without writing anything
+
+    The positions are exactly the ones generated by SoxEngine.metronome().
+    Returns the list of beat positions (in samples) and the
+    position where the metronome ends.
+    """
+    beat_length = 60/float(bpm)
+    last_beat = t-beat_length
+
+    pos = w.samples
+    now = w.cur_time()
+    beats = []
+    while pos/float(RATE) < last_beat:
+        beats.append(pos)
+        pos += click_samples
+        now += beat_length
+        n = int(now*RATE)-pos
+        if n >= 0:
+            pos += n
+    return beats,pos
+
+ENGINES = {
+    'sox': SoxEngine,
+    'native': NativeEngine,
+}
+
+class SoundGenerator:
+    engine = SoxEngine()
+
+    def silence(self, samples):
+        self.engine.silence(self, samples)
+
     def sox_cmd(self, args, samples=-1, wait=True):
         dbg('sox command: sox %r', args)
+        enduroape.perf.count('spawn:sox')
         proc = subprocess.Popen(['sox']+args, stdout=subprocess.PIPE)
         s = samples
         while (samples < 0) or (s > 0):
@@ -54,10 +228,23 @@ class SoundGenerator:
         return self.sox_cmd(['-n']+SOX_ARGS+['-']+args)
 
     def sine(self, time, freq):
-        return self.sox_effect(['synth', '%.5f' % (time), 'sine', str(freq), 'gain', '-3'])
+        return self.engine.sine(self, time, freq)
  
-    def wav_file(self, file):
-        return self.sox_cmd(['-t','wav',file]+SOX_ARGS+['-'])
+    def raw_data(self, data):
+        assert (len(data) % BYTES) == 0 # whole number of samples
+        self.write(data, len(data)/BYTES)
+
+    def wav_file(self, file, cache=True):
+        """Write the samples from a WAV file
+
+        If 'cache' is False, the file is decoded but not kept on
+        the sample cache (e.g. for files that are played only once).
+        """
+        if cache:
+            data = sample_cache.get(file)
+        else:
+            data = decode_wav(file)
+        self.raw_data(data)
 
     def word(self, word):
         return self.wav_file('sounds/words/%s.wav' % (word))
@@ -99,17 +286,19 @@ class MemoryTrack(SoundGenerator):
             other.write(b, samples)
 
 class SoundWriter(SoundGenerator):
-    def __init__(self, raw_out):
+    def __init__(self, raw_out, engine=None):
         self.raw_out = raw_out
         self.samples = 0
+        if engine is not None:
+            self.engine = engine
 
     def write(self, b, samples):
         """Write raw samples
 
         The 'samples' parameter is just a sanity check to make sure
-        the data is correct
+        the data is correct. 'b' may also be a buffer() view.
         """
-        assert type(b) == str and len(b) == BYTES*samples
+        assert isinstance(b, (str, buffer)) and len(b) == BYTES*samples
         self.raw_out.write(b)
         self.samples += samples
 
@@ -120,8 +309,12 @@ class SoundWriter(SoundGenerator):
         return t-self.cur_time()
 
     def samples_to(self, t):
-        """Number of samples needed to go to time 't'"""
-        return int(self.time_to(t)*RATE)
+        """Number of samples needed to go to time 't'
+
+        Calculated from the absolute sample position of 't', so the
+        result doesn't depend on rounding errors of the current position.
+        """
+        return int(t*RATE)-self.samples
 
     def silence_to(self, t):
         samples = self.samples_to(t)
@@ -131,23 +324,72 @@ class SoundWriter(SoundGenerator):
         return True
 
     def metronome(self, bpm, t):
-        beat_length = 60/float(bpm)
-        last_beat = t-beat_length
-
-        beat = MemoryTrack()
-        beat.wav_file('sounds/click.wav')
-
-        now = self.cur_time()
-        while self.cur_time() < last_beat:
-            self.mem_tracks(beat)
-            now += beat_length
-            self.silence_to(now)
-
+        self.engine.metronome(self, bpm, t)
 
     def mem_tracks(self, *tracks):
         for t in tracks:
             t.write_to(self)
 
+class TimelineWriter(SoundWriter):
+    """Assemble the whole soundtrack in a single preallocated buffer
+
+    Each chunk is copied directly to its sample offset, and silence
+    just moves the current position. The buffer is an anonymous mmap:
+    it starts zeroed and the memory pages that are never written (the
+    silence) are not even touched, so only the written sound uses
+    memory. The buffer grows if the initial size was not enough.
+    """
+    def __init__(self, samples, engine=None):
+        SoundWriter.__init__(self, None, engine)
+        self.buf = mmap.mmap(-1, max(samples, 1)*BYTES)
+
+    def reserve(self, samples):
+        """Make sure the buffer can hold 'samples' samples"""
+        size = samples*BYTES
+        if size <= len(self.buf):
+            return
+        dbg('timeline: growing buffer to %d samples', samples)
+        buf = mmap.mmap(-1, max(size, len(self.buf)*2))
+        buf.write(buffer(self.buf, 0, self.samples*BYTES))
+        self.buf.close()
+        self.buf = buf
+
+    def write(self, b, samples):
+        assert len(b) == BYTES*samples
+        end = self.samples+samples
+        self.reserve(end)
+        self.buf.seek(self.samples*BYTES)
+        self.buf.write(b)
+        self.samples = end
+
+    def silence(self, samples):
+        self.reserve(self.samples+samples)
+        self.samples += samples
+
+    def save(self, file):
+        """Write the WAV file"""
+        wf = wave.open(file, 'wb')
+        wf.setnchannels(1)
+        wf.setsampwidth(BYTES)
+        wf.setframerate(RATE)
+        wf.writeframes(buffer(self.buf, 0, self.samples*BYTES))
+        wf.close()
+
+class LayoutWriter(SoundWriter):
+    """Keep track of the position of the sounds, without any sound data"""
+    def __init__(self):
+        SoundWriter.__init__(self, None)
+
+    def write(self, b, samples):
+        self.samples += samples
+
+    def silence(self, samples):
+        self.samples += samples
+
+    def metronome(self, bpm, t):
+        click = sample_cache.get(CLICK_FILE)
+        beats,self.samples = metronome_beats(self, bpm, t, len(click)/BYTES)
+
 def word_track(word):
     t = MemoryTrack()
     t.word(word)
@@ -161,11 +403,29 @@ def number_track(n):
 def seconds(*tracks):
     return sum(t.seconds for t in tracks)
 
-def generate_soundtrack(opts, items):
-    proc = subprocess.Popen(['sox']+SOX_ARGS+['-','-t','wav',opts.soundfile], stdin=subprocess.PIPE)
-    f = proc.stdin
-    w = SoundWriter(f)
+def soundtrack_samples(items):
+    """Expected length of the soundtrack, based on the last item"""
+    if not items:
+        return 0
+    state,i = items[-1]
+    return int((state.abs_time+TIMELINE_MARGIN)*RATE)
+
+def is_segment_start(item):
+    """Check if a soundtrack segment starts at 'item'
+
+    Each Referencia, Neutro or NovoTrecho starts a new segment, so a
+    segment covers the sounds of a single reference.
+    """
+    return item.is_a('Referencia') or item.is_a('NovoTrecho') or item.is_a('Neutro')
+
+def render_items(opts, w, items, segments=None):
+    """Generate the sound for 'items', writing it to 'w'
 
+    If 'segments' is not None, the (item index, sample position)
+    of each segment start is appended to it.
+
+    Returns the worst delay found, as a (delay, item) tuple.
+    """
     def silence_to(t):
         if opts.no_silence:
             w.silence(RATE) # silêncio de 1 segundo apenas, para facilitar
@@ -182,7 +442,10 @@ def generate_soundtrack(opts, items):
     worst_late = None
     worst_late_delay = 0
 
-    for state,i in items:
+    for index,(state,i) in enumerate(items):
+        if segments is not None and is_segment_start(i):
+            segments.append( (index, w.samples) )
+
         if i.is_a('Referencia'):
             dbg("abs_time: %r", i.abs_time)
             dbg("we're at: %r", w.cur_time())
@@ -191,7 +454,7 @@ def generate_soundtrack(opts, items):
             nmetros = number_track(i.rel_dist)
 
             desc = MemoryTrack()
-            desc.wav_file('%s/ref%d.wav' % (opts.instructions_dir, i.ref_index))
+            desc.wav_file('%s/ref%d.wav' % (opts.instructions_dir, i.ref_index), cache=False)
             before_desc = i.abs_time - desc.seconds
 
             remaining = w.time_to(before_desc)
@@ -255,8 +518,190 @@ def generate_soundtrack(opts, items):
             w.word('nova-pagina')
             w.number(i.number)
 
-    f.close()
-    proc.wait()
+    return worst_late_delay,worst_late
+
+def sound_bank_signature():
+    """Signature of the word/digit sound files, to invalidate cached segments"""
+    sig = []
+    for d in ['sounds', 'sounds/words', 'sounds/digits']:
+        for f in sorted(os.listdir(d)):
+            st = os.stat(os.path.join(d, f))
+            sig.append( (d, f, st.st_size, st.st_mtime) )
+    return sig
+
+def segment_key(opts, bank, offset, items):
+    """Hash of all the data that affects the sound of a segment"""
+    data = [SEGMENT_CACHE_VERSION, opts.audio_engine, opts.no_silence, offset, bank]
+    for state,i in items:
+        if i.is_a('Referencia'):
+            st = os.stat('%s/ref%d.wav' % (opts.instructions_dir, i.ref_index))
+            data.append( ('ref', i.abs_time, i.rel_dist, int(i.rel_passos), i.ref_index,
+                          state.cur_trecho.steps_bpm, st.st_size, st.st_mtime) )
+        elif i.is_a('Neutro'):
+            data.append( ('neutro', i.abs_time, state.prev_abs_time) )
+        elif i.is_a('NovoTrecho'):
+            data.append( ('trecho', i.speed) )
+        elif i.is_a('NewPage'):
+            data.append( ('page', i.number) )
+    return hashlib.sha1(repr(data)).hexdigest()
+
+def evict_segments(dir, max_bytes, max_age):
+    """Remove the oldest cached segments, by age and by total size
+
+    The segments used by a render are touched, so the segments of the
+    sheets still in use are the last to go.
+    """
+    entries = []
+    for n in os.listdir(dir):
+        if not n.endswith('.raw'):
+            continue
+        fname = os.path.join(dir, n)
+        st = os.stat(fname)
+        entries.append( (st.st_mtime, st.st_size, fname) )
+    entries.sort()
+
+    total = sum(size for mtime,size,fname in entries)
+    now = time.time()
+    for mtime,size,fname in entries:
+        if now-mtime <= max_age and total <= max_bytes:
+            break
+        dbg('segment cache: evicting %s', fname)
+        os.unlink(fname)
+        total -= size
+
+_segment_job = None
+
+def _render_segment(args):
+    """Render a soundtrack segment to a raw file"""
+    start,end,offset,fname = args
+    opts,items = _segment_job
+
+    # the warnings were already reported when calculating the layout
+    disabled = logger.disabled
+    logger.disabled = True
+    try:
+        tmpname = '%s.%d.tmp' % (fname, os.getpid())
+        f = open(tmpname, 'wb')
+        w = SoundWriter(f, ENGINES[opts.audio_engine]())
+        w.samples = offset
+        render_items(opts, w, items[start:end])
+        f.close()
+        os.rename(tmpname, fname)
+    finally:
+        logger.disabled = disabled
+    return w.samples
+
+def render_segments(opts, w, items):
+    """Render 'items' in segments, writing the result to 'w'
+
+    The position of every sound is calculated first (using LayoutWriter),
+    so each segment can be rendered independently starting at the right
+    sample position, using opts.jobs processes. The segments are then
+    concatenated in order.
+
+    If opts.sound_cache is set, the rendered segments are kept on that
+    directory, and segments that didn't change are reused.
+    """
+    global _segment_job
+
+    layout = LayoutWriter()
+    segments = [(0, 0)]
+    r = render_items(opts, layout, items, segments)
+    segments.append( (len(items), layout.samples) )
+
+    if opts.sound_cache:
+        bank = sound_bank_signature()
+        if not os.path.isdir(opts.sound_cache):
+            os.makedirs(opts.sound_cache)
+
+    tmpdir = tempfile.mkdtemp(prefix='enduroape-')
+    try:
+        jobs = []
+        dirty = []
+        for n,((start,offset),(end,end_offset)) in enumerate(zip(segments, segments[1:])):
+            if end <= start:
+                continue
+            if opts.sound_cache:
+                key = segment_key(opts, bank, offset, items[start:end])
+                fname = os.path.join(opts.sound_cache, '%s.raw' % (key))
+                cached = os.path.exists(fname) and os.path.getsize(fname) == (end_offset-offset)*BYTES
+            else:
+                fname = os.path.join(tmpdir, 'seg%d.raw' % (n))
+                cached = False
+
+            job = (start, end, offset, fname)
+            jobs.append( (job, end_offset, cached) )
+            if not cached:
+                dirty.append(job)
+
+        info("segmentos de som: %d, a gerar: %d", len(jobs), len(dirty))
+
+        # the child processes get the items from the parent (using fork),
+        # so they don't need to be pickled
+        _segment_job = (opts, items)
+        pool = None
+        if opts.jobs > 1 and dirty:
+            pool = multiprocessing.Pool(opts.jobs)
+            results = pool.imap(_render_segment, dirty)
+        else:
+            results = itertools.imap(_render_segment, dirty)
+
+        try:
+            for (start,end,offset,fname),end_offset,cached in jobs:
+                if not cached:
+                    # not an assert: this call is what renders the segment
+                    n = results.next()
+                    if n != end_offset:
+                        raise Exception("segmento %s terminou em %d, esperado %d" % (fname, n, end_offset))
+
+                assert w.samples == offset
+                f = open(fname, 'rb')
+                while True:
+                    data = f.read(MAX_SAMPLES*BYTES)
+                    if not data:
+                        break
+                    w.raw_data(data)
+                f.close()
+                if opts.sound_cache:
+                    # the segment was just used, so it is the last to be evicted
+                    os.utime(fname, None)
+                else:
+                    os.unlink(fname)
+                assert w.samples == end_offset
+        finally:
+            if pool is not None:
+                pool.terminate()
+            _segment_job = None
+    finally:
+        shutil.rmtree(tmpdir)
+
+    if opts.sound_cache:
+        evict_segments(opts.sound_cache, opts.sound_cache_max_size*1024*1024, opts.sound_cache_max_age*24*3600)
+
+    assert w.samples == layout.samples
+    return r
+
+def generate_soundtrack(opts, items):
+    engine = ENGINES[opts.audio_engine]()
+    if opts.timeline:
+        w = TimelineWriter(soundtrack_samples(items), engine)
+    else:
+        enduroape.perf.count('spawn:sox')
+        proc = subprocess.Popen(['sox']+SOX_ARGS+['-','-t','wav',opts.soundfile], stdin=subprocess.PIPE)
+        w = SoundWriter(proc.stdin, engine)
+
+    if opts.jobs > 1 or opts.sound_cache:
+        worst_late_delay,worst_late = render_segments(opts, w, items)
+    else:
+        worst_late_delay,worst_late = render_items(opts, w, items)
+
+    if opts.timeline:
+        w.save(opts.soundfile)
+    else:
+        w.raw_out.close()
+        proc.wait()
+
+    info("cache de sons: %d hits, %d misses, %d bytes", sample_cache.hits, sample_cache.misses, sample_cache.bytes)
 
     if worst_late is not None:
         info("Pior atraso: %.2f segundos (referencia: %r)", worst_late_delay, worst_late.ref_id)
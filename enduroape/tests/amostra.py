@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+#
+# Planilha de exemplo e funções comuns aos testes
+#
+import logging
+from enduroape.trilhape import planilha
+
+class O:
+    pass
+
+# duas páginas lado a lado, como na saída do 'pdftotext -layout'
+SHEET = u'''
+                    TRILHA PÉ AVENTURA                                          TRILHA PÉ AVENTURA
+
+Distância Referência                    Observações             Distância Referência                    Observações
+
+          TRECHO 1                                                 035    Siga pela estrada
+          Velocidade Média 30 m/min                             00:01:44
+   000    Largada em frente                                        077
+00:00:00                                                                  NEUTRALIZADO DE 2 MINUTOS
+   000                                                                    00:03:44
+   021    Vire a esquerda na porteira                              014    Passe a ponte sobre o rio
+00:00:42                                                        00:04:12
+   021                                                             091
+   021    Desça com cuidado, piso liso
+00:01:24  fitas na cerca
+   042
+          e depois siga o carreiro
+
+                                                  Página 1                                                        Página 2'''.split(u'\n')
+
+def parse(sheet, parciais=False):
+    opts = O()
+    opts.parciais = parciais
+    opts.estrategia_parciais = planilha.ESTRATEGIA_PADRAO
+    groups = list(planilha.split_groups(sheet))
+    pages = []
+    for g in groups:
+        g.find_width()
+        g.find_page_limits()
+        pages.extend(g.pages)
+    return pages, list(planilha.parse_pages(opts, pages))
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
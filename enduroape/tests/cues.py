@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+import unittest, socket, select, json
+from enduroape import cues
+from amostra import SHEET, parse, ListHandler
+
+CLIENTS = 300
+
+class FakeClock:
+    def __init__(self, t):
+        self.t = t
+
+    def __call__(self):
+        return self.t
+
+class TesteCues(unittest.TestCase):
+    def setUp(self):
+        pages,items = parse(SHEET, parciais=True)
+        self.cues = list(cues.circuit_cues(items))
+        self.clock = FakeClock(900.0)
+        self.server = cues.CueServer(self.cues, 1000.0, ('127.0.0.1', 0), clock=self.clock)
+        self.clients = []
+
+    def tearDown(self):
+        for c in self.clients:
+            c.close()
+        self.server.close()
+
+    def connect(self, n):
+        for k in xrange(n):
+            self.clients.append(socket.create_connection(self.server.address))
+        while len(self.server.clients) < len(self.clients):
+            self.server.poll(0.1)
+
+    def pending(self, sock):
+        r,w,x = select.select([sock], [], [], 0)
+        return bool(r)
+
+    def testCircuitCues(self):
+        names = [c['cue'] for t,c in self.cues]
+        self.assertEquals(names[:3], ['nova-pagina', 'novo-trecho', 'referencia'])
+        neutro = [(t, c['cue']) for t,c in self.cues if c.get('ref') == '5']
+        self.assertEquals(neutro, [(104, 'neutro'), (214, '10-segundos-neutro'), (224, 'neutro-acabou')])
+
+    def testShortNeutro(self):
+        pages,items = parse(SHEET)
+        s,i = [(s,i) for s,i in items if i.is_a('Neutro')][0]
+        # a 5s neutral: no time for the 10s warning
+        s = s._replace(prev_abs_time=i.abs_time-5)
+        handler = ListHandler()
+        cues.logger.addHandler(handler)
+        try:
+            names = [c['cue'] for t,c in cues.circuit_cues([(s,i)])]
+        finally:
+            cues.logger.removeHandler(handler)
+        self.assertEquals(names, ['neutro', 'neutro-acabou'])
+        self.assertEquals(len(handler.messages), 1)
+
+    def testSchedule(self):
+        self.connect(1)
+        c = self.clients[0]
+        f = c.makefile()
+        hello = json.loads(f.readline())
+        self.assertEquals((hello['cue'], hello['t'], hello['cues']), ('hello', -100, len(self.cues)))
+
+        # nothing before the start
+        self.clock.t = 999.9
+        self.server.step(0)
+        self.assertFalse(self.pending(c))
+
+        self.clock.t = 1000.0
+        self.server.step(0)
+        self.assertEquals([json.loads(f.readline())['cue'] for k in xrange(3)],
+                          ['nova-pagina', 'novo-trecho', 'referencia'])
+        self.assertFalse(self.pending(c))
+
+    def testManyClients(self):
+        self.connect(CLIENTS)
+        for t in sorted(set(t for t,c in self.cues)):
+            self.clock.t = 1000.0+t
+            self.server.step(0)
+        self.assertFalse(self.server.step(0))
+        self.assertEquals(self.server.sent, len(self.cues))
+
+        expected = ['hello']+[c['cue'] for t,c in sorted(self.cues, key=lambda c: c[0])]
+        for c in self.clients:
+            f = c.makefile()
+            got = [json.loads(f.readline()) for k in xrange(len(expected))]
+            self.assertEquals([l['cue'] for l in got], expected)
+            times = [l['t'] for l in got[1:]]
+            self.assertEquals(times, sorted(times))
+
+    def testDisconnect(self):
+        self.connect(3)
+        self.clients.pop().close()
+        while len(self.server.clients) > 2:
+            self.server.poll(0.1)
+        self.clock.t = 1000.0
+        self.server.step(0)
+        self.assertEquals(len(self.server.clients), 2)
+
+    def testBusyPort(self):
+        self.assertRaises(socket.error, cues.listen, self.server.address)
+
+    def testDrainTimeout(self):
+        # a client that doesn't read the last cues
+        server = cues.CueServer([], 1000.0, ('127.0.0.1', 0), clock=self.clock)
+        self.clients.append(socket.create_connection(server.address))
+        while not server.clients:
+            server.poll(0.1)
+        c = server.clients.values()[0]
+        c.flush = lambda: True
+        c.push('x')
+        def poll(timeout):
+            self.clock.t += timeout
+        server.poll = poll
+        server.run()
+        self.assertEquals(self.clock.t, 900.0+cues.DRAIN_TIMEOUT)
+        self.assertEquals(server.clients, {})
+
+    def testInterrupted(self):
+        self.connect(1)
+        def interrupt():
+            raise KeyboardInterrupt()
+        self.server.clock = interrupt
+        self.assertRaises(KeyboardInterrupt, self.server.run)
+        # run() closed the client connections
+        self.assertEquals(self.server.clients, {})
+        c = self.clients[0]
+        c.settimeout(1)
+        f = c.makefile()
+        self.assertEquals(json.loads(f.readline())['cue'], 'hello')
+        self.assertEquals(f.read(), '')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,5 @@
 import unittest, sys
-from enduroape.trilhape.planilha import CircuitoState
+from enduroape.trilhape.planilha import CircuitoState, TabelaParciais, PASSO, ESTRATEGIAS_PARCIAIS
 
 import logging
 #logging.basicConfig(stream=sys.stderr, level=logging.DEBUG)
@@ -35,6 +35,25 @@ class TesteParciais(unittest.TestCase):
         al(107, [5, 10, 20, 30, 40, 50, 60, 70, 80, 90, 100])
         al(108, [5, 10, 20, 30, 40, 50, 60, 70, 80, 90, 100, 105])
 
+class TesteTabelaParciais(unittest.TestCase):
+    def testTabela(self):
+        # 14 m (10 passos) em 20 s, 0 m, 42 m (30 passos) em 60 s
+        t = TabelaParciais([100, 114, 114, 156], [50, 70, 80, 140])
+        self.assertEquals(len(t), 5)
+        self.assertEquals(list(t.ref), [1, 3, 3, 3, 3])
+        self.assertEquals(list(t.parcial_index), [1, 1, 2, 3, 4])
+        self.assertEquals([round(d/PASSO) for d in t.rel_dist], [5, 5, 10, 20, 25])
+        self.assertEquals(list(t.abs_time), [60, 90, 100, 120, 130])
+        self.assertEquals(list(t.rel_time), [10, 10, 20, 40, 50])
+
+    def testEstrategia(self):
+        e = ESTRATEGIAS_PARCIAIS['esparsa']
+        self.assertEquals(e.posicoes(100), (5, 10, 20, 40, 60, 80, 90))
+        self.assertTrue(e.posicoes(100) is e.posicoes(100))
+
+        t = TabelaParciais([0, 42], [0, 60], ESTRATEGIAS_PARCIAIS['densa'])
+        self.assertEquals([round(d/PASSO) for d in t.rel_dist], [5, 10, 15, 20, 25])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+import unittest, sys, os, tempfile, shutil
+from enduroape.trilhape import pdftext
+
+class TesteIsPdf(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, data):
+        f = os.path.join(self.dir, 'f')
+        open(f, 'wb').write(data)
+        return f
+
+    def testMagic(self):
+        self.assertTrue(pdftext.is_pdf(self.write('%PDF-1.4\n...')))
+        self.assertTrue(pdftext.is_pdf(self.write('\r\n%PDF-1.3\n')))
+        self.assertFalse(pdftext.is_pdf(self.write('TRILHA PÉ AVENTURA\n')))
+        self.assertFalse(pdftext.is_pdf(self.write('')))
+
+def chars(x, y, text, w=5, h=10):
+    return [(x+i*w, y, x+(i+1)*w, y+h, c) for i,c in enumerate(text)]
+
+class TesteLayout(unittest.TestCase):
+    def testLines(self):
+        c = chars(10, 700, u'TRECHO 1') + chars(110, 700, u'035') + \
+            chars(10, 690, u'000') + chars(25, 660, u'Página 1')
+        self.assertEquals(pdftext.layout_lines(c),
+                          [u'TRECHO 1            035',
+                           u'000',
+                           u'',
+                           u'',
+                           u'   Página 1'])
+
+    def testOverlap(self):
+        # characters closer than the width are not overwritten
+        c = [(0, 0, 5, 10, u'a'), (2, 0, 7, 10, u'b'), (10, 0, 15, 10, u'c')]
+        self.assertEquals(pdftext.layout_lines(c), [u'abc'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+import unittest
+from enduroape import perf
+
+class FakeClock:
+    def __init__(self):
+        self.t = 0.0
+
+    def __call__(self):
+        return self.t
+
+def slow(clock, items, t):
+    for i in items:
+        clock.t += t
+        yield i
+
+class TesteProfiler(unittest.TestCase):
+    def tearDown(self):
+        perf.current = None
+
+    def testDisabled(self):
+        l = [1, 2]
+        self.assertTrue(perf.wrap('a', l) is l)
+        self.assertEquals(perf.call('a', sum, l), 3)
+        perf.count('x')
+
+    def testNested(self):
+        clock = FakeClock()
+        p = perf.current = perf.Profiler(clock=clock)
+        inner = perf.wrap('inner', slow(clock, [1, 2, 3], 0.02))
+        outer = perf.wrap('outer', slow(clock, inner, 0.01))
+        self.assertEquals(perf.call('total', list, outer), [1, 2, 3])
+        perf.count('spawn:sox', 2)
+
+        s = p.stages
+        self.assertEquals(s.keys(), ['total', 'outer', 'inner'])
+        self.assertEquals((s['inner'].items, s['outer'].items), (3, 3))
+        self.assertEquals(s['outer'].calls, 4)
+        # the time of each stage doesn't include the nested ones
+        self.assertAlmostEquals(s['inner'].wall, 0.06)
+        self.assertAlmostEquals(s['outer'].wall, 0.03)
+        self.assertAlmostEquals(s['total'].wall, 0)
+        self.assertAlmostEquals(p.as_dict()['wall'], 0.09)
+        self.assertEquals(p.as_dict()['counters'], {'spawn:sox': 2})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,400 @@
+# -*- coding: utf-8 -*-
+import unittest, sys, os, tempfile, shutil, StringIO
+from enduroape.trilhape import planilha
+from enduroape import bench
+from amostra import O, SHEET, parse, ListHandler
+
+import logging
+#logging.basicConfig(stream=sys.stderr, level=logging.DEBUG)
+
+class TesteKeywords(unittest.TestCase):
+    def testKeywords(self):
+        kw = planilha.check_keywords
+        self.assertEquals(kw(u'Siga em frente pela TRILHA'), set(['frente', 'trilha']))
+        self.assertEquals(kw(u'Atenção: descendo, piso lisa'), set(['atencao', 'descer', 'liso']))
+        self.assertEquals(kw(u'arames e arame, buracos'), set(['arame', 'buraco']))
+        # whole words only
+        self.assertEquals(kw(u'ritmo subindo riozinho'), set(['subir']))
+
+class TesteItems(unittest.TestCase):
+    def testIsA(self):
+        r = planilha.Referencia(None, 0, rel_dist=10, abs_time=5)
+        self.assertEquals(r.type, 'referencia')
+        self.assertTrue(r.is_a('Referencia'))
+        self.assertTrue(r.is_a('referencia'))
+        self.assertFalse(r.is_a('Neutro'))
+        self.assertEquals(r.properties(), dict(page=None, sheet_line=0, rel_dist=10, abs_time=5))
+        self.assertRaises(AttributeError, setattr, r, 'foo', 1)
+
+class TesteParseSheet(unittest.TestCase):
+    def testParse(self):
+        pages,items = parse(SHEET)
+        self.assertEquals([p.number for p in pages], ['1', '2'])
+
+        refs = [(i.ref_id, i.rel_dist, s.abs_time) for s,i in items if i.is_a('Referencia') or i.is_a('Neutro')]
+        self.assertEquals(refs, [('1', 0, 0), ('2', 21, 42), ('3', 21, 84),
+                                 ('4', 35, 104), ('5', 0, 224), ('6', 14, 252)])
+
+        trechos = [(i.number, i.speed) for s,i in items if i.is_a('NovoTrecho')]
+        self.assertEquals(trechos, [(1, 30)])
+
+        r = [i for s,i in items if i.is_a('Referencia')]
+        self.assertEquals(r[1].keywords, set(['esquerda', 'porteira']))
+        self.assertEquals(r[2].keywords, set(['cuidado', 'liso', 'fitas', 'cerca', 'carreiro']))
+
+    def testSynthetic(self):
+        pages,items = parse(list(bench.sheet_dump(5)))
+        self.assertEquals([p.number for p in pages], ['1', '2', '3', '4', '5'])
+        refs = [i for s,i in items if i.is_a('Referencia')]
+        self.assertEquals(len([r for r in refs if r.rel_dist > 0]), 5*bench.REFS_PER_PAGE)
+
+    def testStopEarly(self):
+        # a consumer that stops early (e.g. '| head') is not a parse error
+        pages,items = parse(SHEET)
+        stderr = sys.stderr
+        sys.stderr = StringIO.StringIO()
+        try:
+            g = planilha._parse_pages(pages)
+            g.next()
+            g.next()
+            g.close()
+            report = sys.stderr.getvalue()
+        finally:
+            sys.stderr = stderr
+        self.assertEquals(report, '')
+
+    def testSidenotes(self):
+        pages,items = parse(SHEET)
+        p = pages[0]
+        # os dados da referência 2 terminam na linha 12 da página
+        self.assertEquals(p.lines[12].split()[0], '021')
+        self.assertTrue('Referencia: 2' in p.sidenotes[12-3])
+        self.assertTrue('passos: 15.0' in p.sidenotes[12-1])
+
+class TestePageLimits(unittest.TestCase):
+    def group(self, lines):
+        g = list(planilha.split_groups(lines))[0]
+        g.find_width()
+        return g
+
+    def testLimits(self):
+        g = self.group(SHEET)
+        g.find_page_limits()
+        p1,p2 = g.pages
+        self.assertEquals((p1.left, p1.right, p2.left), (0, p1.min_right+5, p1.right))
+        self.assertEquals(p1.limit_confidence, 1.0)
+        # the page lines are padded like the group lines
+        self.assertEquals(len(p1.lines), len(SHEET))
+        self.assertEquals(set(len(l) for l in p1.lines), set([p1.width]))
+        self.assertEquals(list(p2.lines)[4], SHEET[4][p2.left:].ljust(g.width+3-p2.left))
+
+    def testNoLimit(self):
+        # text on all the candidate columns
+        lines = SHEET[:-1] + [u'x'*60 + u'Página 1'.rjust(60) + u'x'*20 + u'Página 2']
+        g = self.group(lines)
+        self.assertRaises(planilha.PageLimitError, g.find_page_limits)
+
+class TesteTrace(unittest.TestCase):
+    def setUp(self):
+        self.handler = ListHandler()
+        planilha.logger.addHandler(self.handler)
+        planilha.logger.setLevel(logging.DEBUG)
+
+    def tearDown(self):
+        planilha.logger.removeHandler(self.handler)
+        planilha.logger.setLevel(logging.NOTSET)
+        planilha.set_trace(False)
+
+    def testPageList(self):
+        self.assertEquals(planilha.parse_page_list('3,5-7'), set(['3', '5', '6', '7']))
+
+    def testFilter(self):
+        planilha.set_trace(True, set(['2']))
+        parse(SHEET)
+        traced = [m for m in self.handler.messages if m.startswith('[pag')]
+        self.assertTrue(traced)
+        self.assertEquals([m for m in traced if not m.startswith(('[pag 2:', '[pag 1/2:'))], [])
+
+    def testGroups(self):
+        # split_groups() only knows the page numbers at the end of the group
+        planilha.set_trace(True, set(['2']))
+        parse(SHEET)
+        self.assertTrue([m for m in self.handler.messages if m.startswith('[pag 1/2:') and 'letter:' in m])
+
+        del self.handler.messages[:]
+        planilha.set_trace(True, set(['3']))
+        parse(SHEET)
+        self.assertEquals([m for m in self.handler.messages if m.startswith('[pag')], [])
+
+    def testDisabled(self):
+        parse(SHEET)
+        self.assertEquals([m for m in self.handler.messages if m.startswith('[pag')], [])
+
+class TesteSheetCache(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.fname = os.path.join(self.dir, 'planilha.txt')
+        f = open(self.fname, 'w')
+        f.write(u'\n'.join(SHEET).encode('utf-8'))
+        f.close()
+
+        self.opts = O()
+        self.opts.parciais = True
+        self.opts.estrategia_parciais = planilha.ESTRATEGIA_PADRAO
+        self.opts.pdf_extractor = 'pdftotext'
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testRoundTrip(self):
+        c = planilha.SheetCache(os.path.join(self.dir, 'cache'))
+        key = c.key(self.fname, self.opts)
+        self.assertEquals(c.load(key), None)
+
+        pages,items = parse(SHEET, parciais=True)
+        c.save(key, pages, items)
+        cpages,citems = c.load(key)
+
+        self.assertEquals([p.sidenotes for p in cpages], [p.sidenotes for p in pages])
+        self.assertEquals([(s.abs_time, s.last_ref_index, i.type) for s,i in citems],
+                          [(s.abs_time, s.last_ref_index, i.type) for s,i in items])
+        # the previous_state chain is restored
+        s = citems[-1][0]
+        self.assertEquals(s.previous_state.last_ref.ref_id, '5')
+
+        self.opts.estrategia_parciais = 'densa'
+        self.assertNotEquals(c.key(self.fname, self.opts), key)
+
+    def testMessages(self):
+        c = planilha.SheetCache(os.path.join(self.dir, 'cache'))
+        pages,items = parse(SHEET)
+        c.save('a', pages, items, [('trilhape.planilha', logging.ERROR, u'ref 3: erro')])
+
+        handler = ListHandler()
+        planilha.logger.addHandler(handler)
+        try:
+            c.load('a')
+        finally:
+            planilha.logger.removeHandler(handler)
+        self.assertEquals(handler.messages[-1], u'ref 3: erro')
+
+    def testEvict(self):
+        c = planilha.SheetCache(os.path.join(self.dir, 'cache'), max_bytes=0)
+        pages,items = parse(SHEET)
+        c.save('a', pages, items)
+        self.assertEquals(os.listdir(c.dir), [])
+
+class TesteOutputs(unittest.TestCase):
+    def testParseOutput(self):
+        po = planilha.parse_output
+        self.assertEquals(po('text'), ('text', [], '-'))
+        self.assertEquals(po('html:a.html'), ('html', [], 'a.html'))
+        self.assertEquals(po('tmpl:t.tmpl'), ('tmpl', ['t.tmpl'], '-'))
+        self.assertEquals(po('tmpl:t.tmpl:a.tex'), ('tmpl', ['t.tmpl'], 'a.tex'))
+        self.assertEquals(po('sound:a.wav'), ('sound', [], 'a.wav'))
+        self.assertRaises(ValueError, po, 'foo')
+        self.assertRaises(ValueError, po, 'sound')
+        self.assertRaises(ValueError, po, 'text:a:b')
+
+    def testRunOutputs(self):
+        pages,items = parse(SHEET)
+        opts = O()
+        opts.jobs = 1
+
+        text = StringIO.StringIO()
+        planilha.format_text(items, text)
+        html = StringIO.StringIO()
+        planilha.format_html(items, html)
+
+        old = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            planilha.run_outputs(opts, iter(items), [('html', [], '-'), ('text', [], '-')])
+            r = sys.stdout.getvalue()
+        finally:
+            sys.stdout = old
+        self.assertEquals(r, html.getvalue()+text.getvalue())
+
+class TesteOutputSink(unittest.TestCase):
+    def testBuffer(self):
+        out = StringIO.StringIO()
+        s = planilha.OutputSink(out, bufsize=10)
+        s.line(u'Página')
+        s.write('1')
+        self.assertEquals(out.getvalue(), '')
+        s.line(u'ção')
+        self.assertEquals(out.getvalue(), u'Página\n1ção\n'.encode('utf-8'))
+        s.write(u'x')
+        s.flush()
+        self.assertEquals(out.getvalue(), u'Página\n1ção\nx'.encode('utf-8'))
+
+    def testPageFlush(self):
+        # the text of a page is written before the next page is parsed
+        pages,items = parse(SHEET)
+        out = StringIO.StringIO()
+        seen = []
+        def gen():
+            for s,i in items:
+                yield s,i
+                # resumed when the formatter asks for the next item
+                if i.is_a('NewPage'):
+                    seen.append(out.getvalue())
+        planilha.format_text(gen(), out)
+        self.assertEquals(len(seen), 2)
+        self.assertTrue('TRECHO 1' in seen[1])
+
+    def testFd(self):
+        r,w = os.pipe()
+        s = planilha.OutputSink(fd=w)
+        s.line(u'ação')
+        s.flush()
+        os.close(w)
+        self.assertEquals(os.read(r, 100), u'ação\n'.encode('utf-8'))
+        os.close(r)
+
+class TesteCircuitoIndex(unittest.TestCase):
+    def setUp(self):
+        pages,items = parse(SHEET, parciais=True)
+        self.items = items
+        self.index = planilha.CircuitoIndex(items)
+
+    def testTypes(self):
+        ix = self.index
+        self.assertEquals(ix.of_type('Referencia'), [(s,i) for s,i in self.items if i.is_a('Referencia')])
+        self.assertEquals(ix.of_type(), self.items)
+        self.assertEquals(ix.of_type(''), self.items)
+        self.assertEquals(ix.of_type('foo'), [])
+
+    def testRanges(self):
+        ix = self.index
+        self.assertEquals([i.ref_id for s,i in ix.between(42, 104, 'Referencia')], ['2', '3'])
+        self.assertEquals([i.ref_id for s,i in ix.between(84, type='Neutro')], ['5'])
+        self.assertEquals([i.ref_id for s,i in ix.between_dist(21, 50, 'Referencia')], ['2', '3'])
+        self.assertEquals(ix.next_after(42)[1].ref_id, '3')
+        self.assertEquals(ix.next_after(252), None)
+        self.assertEquals(ix.last_before(100)[1].ref_id, '3')
+        self.assertEquals(ix.last_before(-1), None)
+        s,p = ix.next_after(0, 'Parcial')
+        self.assertEquals(p.ref_id, '1.1')
+
+    def testParcialDist(self):
+        ix = self.index
+        s,p = ix.of_type('Parcial')[0]
+        # the state keeps the distance of the previous reference
+        self.assertNotEquals(s.abs_dist, p.abs_dist)
+        self.assertEquals(ix.dists['parcial'][0], p.abs_dist)
+        self.assertEquals(ix.between_dist(p.abs_dist, p.abs_dist+0.5, 'Parcial'), [(s,p)])
+
+    def testTrechos(self):
+        t, = self.index.trechos
+        self.assertEquals((t.number, t.speed, t.referencias, t.neutros, t.neutro_time),
+                          (1, 30, 5, 1, 120))
+        self.assertEquals((t.start_time, t.end_time, t.dist), (0, 252, 91))
+        self.assertEquals(self.index.trecho(1)[0][1].type, 'novotrecho')
+
+class TesteTemplateNamespace(unittest.TestCase):
+    def testParciais(self):
+        # the batch over the whole circuit matches the partials of the parser
+        pages,items = parse(SHEET, parciais=True)
+        parsed = [(i.ref_id, i.abs_time, i.abs_dist, i.rel_time) for s,i in items if i.is_a('Parcial')]
+        pages,items = parse(SHEET)
+        ns = planilha.TemplateNamespace(None, items)
+        self.assertEquals([(i.ref_id, i.abs_time, i.abs_dist, i.rel_time) for i in ns.parciais()], parsed)
+        self.assertTrue(len(list(ns.parciais('densa'))) > len(parsed))
+
+class TesteTemplateLoader(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.tmpl = os.path.join(self.dir, 't.tmpl')
+        self.write(u'#for s,i in $circuito("Referencia")\n$i.ref_id\n#end for\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, text):
+        f = open(self.tmpl, 'w')
+        f.write(text.encode('utf-8'))
+        f.close()
+
+    def render(self, loader):
+        pages,items = parse(SHEET)
+        ns = planilha.TemplateNamespace(None, items)
+        return unicode(loader.get(self.tmpl)(searchList=[ns]))
+
+    def testCache(self):
+        cache = os.path.join(self.dir, 'cache')
+        l = planilha.TemplateLoader(cache)
+        self.assertEquals(self.render(l), u'1\n2\n3\n4\n6\n')
+        self.assertTrue(l.get(self.tmpl) is l.get(self.tmpl))
+        self.assertEquals((l.hits, l.misses), (0, 1))
+
+        # another process: loaded from the disk
+        l = planilha.TemplateLoader(cache)
+        self.assertEquals(self.render(l), u'1\n2\n3\n4\n6\n')
+        self.assertEquals((l.hits, l.misses), (1, 0))
+
+        # the template changed
+        self.write(u'#for s,i in $circuito("NovoTrecho")\n$i.number\n#end for\n')
+        os.utime(self.tmpl, (0, 0))
+        self.assertEquals(self.render(l), u'1\n')
+        self.assertEquals(len(os.listdir(cache)), 1)
+
+class TesteBatch(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testFindSheets(self):
+        for f in ['b.pdf', 'a.txt', 'x.html', 'sub/c.TXT', 'saida/a.txt']:
+            f = os.path.join(self.dir, f)
+            if not os.path.isdir(os.path.dirname(f)):
+                os.makedirs(os.path.dirname(f))
+            open(f, 'w').close()
+        r = planilha.find_sheets(self.dir, [os.path.join(self.dir, 'saida')])
+        self.assertEquals([os.path.relpath(f, self.dir) for f in r], ['a.txt', 'b.pdf', 'sub/c.TXT'])
+
+    def testBatchOutputs(self):
+        outputs = [('text', [], '-'), ('tmpl', ['templates/latex.tmpl'], '-'),
+                   ('html', [], '%s-cel.html'), ('sound', [], 'guia.wav')]
+        r = planilha.batch_outputs(outputs, 'out', 'dir/GRADUADOS.pdf')
+        self.assertEquals([f for k,a,f in r], ['out/GRADUADOS.txt', 'out/GRADUADOS.latex',
+                                               'out/GRADUADOS-cel.html', 'out/GRADUADOS.guia.wav'])
+
+    def testBatchSubdirs(self):
+        r = planilha.batch_outputs([('text', [], '-')], 'out', 'dir/etapa1/GRADUADOS.pdf', 'dir')
+        self.assertEquals([f for k,a,f in r], ['out/etapa1/GRADUADOS.txt'])
+        r = planilha.batch_outputs([('text', [], '-')], 'out', 'dir/GRADUADOS.pdf', 'dir')
+        self.assertEquals([f for k,a,f in r], ['out/GRADUADOS.txt'])
+
+    def testRunBatch(self):
+        for f in ['etapa1/TREKKERS.txt', 'etapa2/TREKKERS.txt', 'etapa1.txt', 'etapa1.pdf']:
+            f = os.path.join(self.dir, f)
+            if not os.path.isdir(os.path.dirname(f)):
+                os.makedirs(os.path.dirname(f))
+            open(f, 'w').write(u'\n'.join(SHEET).encode('utf-8'))
+        opts = O()
+        for k,v in dict(batch_dir=self.dir, batch_out=None, jobs=1, parciais=False,
+                        estrategia_parciais=planilha.ESTRATEGIA_PADRAO, pdf_extractor='pdftotext',
+                        cache_dir=None, show_pages=False).items():
+            setattr(opts, k, v)
+        stderr = sys.stderr
+        sys.stderr = StringIO.StringIO()
+        try:
+            self.assertEquals(planilha.run_batch(opts, [('text', [], '-')]), 1)
+            report = sys.stderr.getvalue()
+        finally:
+            sys.stderr = stderr
+        # etapa1.txt has the same outputs as etapa1.pdf
+        errors = [l for l in report.split('\n') if 'ERRO' in l]
+        self.assertEquals(len(errors), 1)
+        self.assertTrue(errors[0].startswith(os.path.join(self.dir, 'etapa1.txt')))
+        self.assertTrue(errors[0].endswith(os.path.join(self.dir, 'etapa1.pdf')))
+        out = os.path.join(self.dir, 'saida')
+        for f in ['etapa1/TREKKERS.txt', 'etapa2/TREKKERS.txt', 'etapa1.txt']:
+            self.assertTrue('TRECHO 1' in open(os.path.join(out, f)).read())
+
+
+if __name__ == '__main__':
+    unittest.main()
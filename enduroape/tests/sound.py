@@ -0,0 +1,220 @@
+import unittest, sys, os, tempfile, shutil, wave, StringIO
+from enduroape import sound
+
+def write_wav(fname, samples):
+    w = wave.open(fname, 'wb')
+    w.setnchannels(1)
+    w.setsampwidth(sound.BYTES)
+    w.setframerate(sound.RATE)
+    w.writeframes('\x01\x00'*samples)
+    w.close()
+
+class TesteSampleCache(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def wav(self, name, samples):
+        f = os.path.join(self.dir, name)
+        write_wav(f, samples)
+        return f
+
+    def testHitMiss(self):
+        c = sound.SampleCache()
+        f = self.wav('a.wav', 100)
+        self.assertEquals(c.get(f), '\x01\x00'*100)
+        self.assertEquals(c.get(f), '\x01\x00'*100)
+        self.assertEquals((c.hits, c.misses), (1, 1))
+        self.assertEquals(c.bytes, 200)
+
+    def testEviction(self):
+        c = sound.SampleCache(max_bytes=500)
+        a = self.wav('a.wav', 100)
+        b = self.wav('b.wav', 100)
+        d = self.wav('d.wav', 100)
+        c.get(a)
+        c.get(b)
+        c.get(a) # 'b' is now the least recently used
+        c.get(d)
+        self.assertEquals(c.entries.keys(), [a, d])
+        self.assertEquals(c.bytes, 400)
+
+        big = self.wav('big.wav', 1000)
+        c.get(big)
+        self.assertTrue(big not in c.entries)
+
+    def testMemoryTrack(self):
+        f = self.wav('a.wav', 10)
+        t = sound.MemoryTrack()
+        t.wav_file(f)
+        t.wav_file(f, cache=False)
+        self.assertEquals(t.samples, 20)
+
+class SoundDirTestCase(unittest.TestCase):
+    """Runs the test inside a directory with a 'sounds/click.wav' file"""
+    def setUp(self):
+        self.olddir = os.getcwd()
+        self.dir = tempfile.mkdtemp()
+        os.chdir(self.dir)
+        os.mkdir('sounds')
+        write_wav(sound.CLICK_FILE, 1000)
+
+    def tearDown(self):
+        os.chdir(self.olddir)
+        shutil.rmtree(self.dir)
+        sound.sample_cache.clear()
+
+    def render(self, engine, f):
+        out = StringIO.StringIO()
+        w = sound.SoundWriter(out, engine)
+        f(w)
+        return w.samples, out.getvalue()
+
+class TesteNativeEngine(SoundDirTestCase):
+    def assertSameOutput(self, f):
+        self.assertEquals(self.render(sound.SoxEngine(), f),
+                          self.render(sound.NativeEngine(), f))
+
+    def testSilence(self):
+        self.assertSameOutput(lambda w: w.silence(sound.MAX_SAMPLES+10))
+
+    def testMetronome(self):
+        def f(w):
+            w.silence(123)
+            w.metronome(85.7, 10.3)
+            w.metronome(120, 33)
+        self.assertSameOutput(f)
+
+    def testMetronomeLongClick(self):
+        # click longer than the beat: beats are delayed
+        def f(w):
+            w.metronome(6000, 3)
+        self.assertSameOutput(f)
+
+    def testSine(self):
+        w = sound.SoundWriter(StringIO.StringIO(), sound.NativeEngine())
+        w.sine(0.5, 440)
+        self.assertEquals(w.samples, sound.RATE/2)
+
+class TesteTimelineWriter(SoundDirTestCase):
+    def testSameOutput(self):
+        def f(w):
+            w.silence(500)
+            w.metronome(100, 5)
+            w.wav_file(sound.CLICK_FILE)
+            w.silence_to(7.5)
+
+        samples,data = self.render(sound.NativeEngine(), f)
+
+        # start with a buffer that is too small, to make it grow
+        t = sound.TimelineWriter(1000, sound.NativeEngine())
+        f(t)
+        t.save('out.wav')
+
+        wf = wave.open('out.wav', 'rb')
+        self.assertEquals(wf.getnframes(), samples)
+        self.assertEquals(wf.readframes(samples), data)
+
+WORDS = ['trecholongo', 'distanciaparaproxima', 'distancia', 'metros', 'passos',
+         'referencia', 'neutrode', 'minutos', 'segundos', '10-segundos-neutro',
+         'neutro-acabou', 'novo-trecho', 'metros-por-segundo', 'nova-pagina']
+
+class O:
+    pass
+
+class Item:
+    def __init__(self, type, **kwargs):
+        self.type = type
+        self.__dict__.update(kwargs)
+
+    def is_a(self, t):
+        return self.type == t
+
+class TesteRenderParallel(SoundDirTestCase):
+    def setUp(self):
+        SoundDirTestCase.setUp(self)
+        os.mkdir('sounds/words')
+        os.mkdir('sounds/digits')
+        os.mkdir('instr')
+        for w in WORDS:
+            write_wav('sounds/words/%s.wav' % (w), 5000+len(w)*100)
+        for d in range(10):
+            write_wav('sounds/digits/%d.wav' % (d), 3000+d*100)
+
+        self.opts = O()
+        self.opts.no_silence = False
+        self.opts.instructions_dir = 'instr'
+        self.opts.audio_engine = 'native'
+        self.opts.jobs = 3
+        self.opts.sound_cache = None
+        self.opts.sound_cache_max_size = sound.SEGMENT_CACHE_MAX_MB
+        self.opts.sound_cache_max_age = sound.SEGMENT_CACHE_MAX_DAYS
+
+        trecho = Item('NovoTrecho', number=1, speed=40, steps_bpm=57.1)
+        st = O()
+        st.cur_trecho = trecho
+        st.prev_abs_time = 0
+        self.items = [(st, trecho)]
+        t = 0
+        for n in range(1, 12):
+            t += 20+n
+            write_wav('instr/ref%d.wav' % (n), 20000+n*1000)
+            ref = Item('Referencia', ref_index=n, ref_id=str(n), abs_time=t, rel_dist=10*n, rel_passos=10*n/1.4)
+            self.items.append( (st, ref) )
+            if n % 4 == 0:
+                t += 30
+                neutro = Item('Neutro', abs_time=t)
+                nst = O()
+                nst.prev_abs_time = t-30
+                self.items.append( (nst, neutro) )
+
+    def render(self, f):
+        out = StringIO.StringIO()
+        w = sound.SoundWriter(out, sound.NativeEngine())
+        r = f(self.opts, w, self.items)
+        return r, w.samples, out.getvalue()
+
+    def testSameOutput(self):
+        self.assertTrue(self.render(sound.render_items) == self.render(sound.render_segments))
+
+    def testSegmentCache(self):
+        self.opts.jobs = 1
+        self.opts.sound_cache = 'cache'
+        first = self.render(sound.render_segments)
+        nfiles = len(os.listdir('cache'))
+        self.assertTrue(first == self.render(sound.render_segments))
+        self.assertEquals(len(os.listdir('cache')), nfiles)
+
+        # only the segment of the changed reference is generated again
+        write_wav('instr/ref5.wav', 10000)
+        r = self.render(sound.render_segments)
+        self.assertEquals(len(os.listdir('cache')), nfiles+1)
+
+        self.opts.sound_cache = None
+        self.assertTrue(r == self.render(sound.render_items))
+
+    def testSegmentEviction(self):
+        self.opts.jobs = 1
+        self.opts.sound_cache = 'cache'
+        self.render(sound.render_segments)
+        nfiles = len(os.listdir('cache'))
+
+        # only the unused segment (of the old ref5) is too old
+        old = set(os.listdir('cache'))
+        for n in old:
+            os.utime(os.path.join('cache', n), (0, 0))
+        write_wav('instr/ref5.wav', 10000)
+        self.opts.sound_cache_max_age = 1
+        self.render(sound.render_segments)
+        self.assertEquals(len(os.listdir('cache')), nfiles)
+        self.assertEquals(len(old-set(os.listdir('cache'))), 1)
+
+        self.opts.sound_cache_max_size = 0
+        self.render(sound.render_segments)
+        self.assertEquals(os.listdir('cache'), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+import unittest, time, StringIO
+from enduroape.trilhape import planilha
+from enduroape import ticker
+from amostra import SHEET, parse
+
+class FakeClock:
+    """Simulated time: wait() advances the clock, and returns the input lines at their times"""
+    def __init__(self, t=1000.0, lines=()):
+        self.t = t
+        self.lines = list(lines)
+        self.waits = 0
+
+    def __call__(self):
+        return self.t
+
+    def wait(self, timeout):
+        self.waits += 1
+        if self.lines and self.lines[0][0] <= self.t+timeout:
+            t,l = self.lines.pop(0)
+            self.t = max(self.t, t)
+            return l
+        self.t += timeout
+        return None
+
+class TesteTicker(unittest.TestCase):
+    def ticker(self, clock, start=1000.0):
+        pages,items = parse(SHEET)
+        return ticker.Ticker(items, start, clock=clock, wait=clock.wait, out=StringIO.StringIO())
+
+    def testStatus(self):
+        tk = self.ticker(FakeClock())
+        st = tk.status(50)
+        self.assertEquals((st.trecho.number, st.target[1].ref_id, st.remaining), (1, '3', 34))
+        # 21m between the refs 2 (42s) and 3 (84s)
+        self.assertAlmostEquals(st.passos, 21*(84-50)/42.0/planilha.PASSO)
+
+        st = tk.status(150)
+        self.assertEquals((st.target[1].ref_id, st.neutro), ('6', 74))
+        self.assertEquals(tk.status(300).target, None)
+        self.assertEquals(tk.format(tk.status(-10)), u'largada em 00:00:11')
+
+    def testStartTime(self):
+        now = 1500000000.0
+        t = ticker.parse_start('08:30', now)
+        self.assertEquals(time.localtime(t)[3:6], (8, 30, 0))
+        self.assertEquals(ticker.parse_start('agora', now), now)
+        self.assertRaises(ValueError, ticker.parse_start, '8h30')
+
+    def testRun(self):
+        # start 5s ago; mark the ref 2 (42s) 3s late
+        clock = FakeClock(lines=[(1000.0-5+45, '\n')])
+        tk = self.ticker(clock, 1000.0-5)
+        ticks = tk.run()
+        # until just after the end of the circuit (252s), at 10Hz
+        self.assertEquals(ticks, (252-5)*10+2)
+        self.assertEquals(clock.waits, ticks-1)
+        self.assertAlmostEquals(tk.drift, 3)
+        out = tk.out.getvalue()
+        self.assertTrue(u'desvio +3.0s'.encode('utf-8') in out)
+        self.assertTrue(out.split('\r')[-1].startswith('00:04:12 | T1 30 m/min | fim'))
+
+    def testQuit(self):
+        clock = FakeClock(lines=[(1010.0, 'q\n')])
+        tk = self.ticker(clock)
+        self.assertEquals(tk.run(), 100)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+#
+# Acompanhamento da prova em tempo real, no terminal (--ticker)
+#
+
+import sys, time, bisect, array, select, collections
+
+from enduroape.trilhape import planilha
+
+import logging
+logger = logging.getLogger('enduroape.ticker')
+dbg = logger.debug
+
+
+TICK_RATE = 10 # atualizações por segundo
+
+# tipos de item usados como alvo ("próxima referência")
+TARGET_TYPES = ('referencia', 'parcial')
+
+# tipos de item usados para calcular a posição esperada
+WAYPOINT_TYPES = ('referencia', 'parcial', 'neutro')
+
+TickerStatus = collections.namedtuple('TickerStatus', ['race_time', 'trecho', 'target',
+                                                       'remaining', 'passos', 'neutro'])
+
+def parse_start(s, now=None):
+    """Start time: 'HH:MM[:SS]' (today, local time) or 'agora'"""
+    if now is None:
+        now = time.time()
+    if s == 'agora':
+        return now
+    try:
+        parts = [int(p) for p in s.split(':')]
+    except ValueError:
+        parts = []
+    if len(parts) not in (2, 3):
+        raise ValueError("horário de largada inválido: %r" % (s))
+    if len(parts) == 2:
+        parts.append(0)
+    t = time.localtime(now)
+    return time.mktime(t[:3]+tuple(parts)+(0, 0, -1))
+
+class StdinWait:
+    """Wait for a line on stdin, up to 'timeout' seconds
+
+    Returns the line, or None on timeout. select() keeps the loop
+    sleeping between the ticks.
+    """
+    def __init__(self, f=None):
+        self.f = f or sys.stdin
+        self.closed = False
+
+    def __call__(self, timeout):
+        if self.closed:
+            time.sleep(timeout)
+            return None
+        r,w,x = select.select([self.f], [], [], max(timeout, 0))
+        if not r:
+            return None
+        l = self.f.readline()
+        if not l:
+            # EOF, no more marks
+            self.closed = True
+            return None
+        return l
+
+class Ticker:
+    """What's next on the circuit, for a given race time
+
+    The target (Referencia or Parcial), waypoint and trecho times are
+    kept on sorted arrays, so each update is a few bisect() calls.
+
+    'clock' returns the current time (time.time() by default) and
+    'wait(timeout)' waits until the next tick, returning a line typed
+    by the user or None. Both can be replaced to run on simulated
+    time. A line typed when passing a reference records the drift
+    (positive when late); 'q' stops the ticker.
+    """
+    def __init__(self, items, start, rate=TICK_RATE, clock=None, wait=None, out=None):
+        self.start = start
+        self.period = 1.0/rate
+        self.clock = clock or time.time
+        self.wait = wait or StdinWait()
+        self.out = out or sys.stdout
+        self.drift = None
+
+        index = planilha.CircuitoIndex(items)
+        self.targets, self.target_times = self._table(index, TARGET_TYPES)
+        self.waypoints, self.waypoint_times = self._table(index, WAYPOINT_TYPES)
+        self.waypoint_dists = array.array('d', [planilha.item_abs_dist(s, i) for s,i in self.waypoints])
+        self.trechos, self.trecho_times = self._table(index, ('novotrecho',))
+        self.end_time = index.items and index.items[-1][0].abs_time or 0
+
+    def _table(self, index, types):
+        items = [(s,i) for s,i in index.items if i.type in types]
+        return items, array.array('d', [s.abs_time for s,i in items])
+
+    def status(self, t):
+        """TickerStatus for the race time 't' (seconds since the start)"""
+        n = bisect.bisect_right(self.trecho_times, t)
+        trecho = n and self.trechos[n-1][1] or None
+
+        n = bisect.bisect_right(self.target_times, t)
+        target = n < len(self.targets) and self.targets[n] or None
+        remaining = target and target[0].abs_time-t
+
+        # expected position, between the last and the next waypoints
+        n = bisect.bisect_right(self.waypoint_times, t)
+        neutro = None
+        passos = None
+        if n < len(self.waypoints):
+            t0,d0 = 0, 0
+            if n > 0:
+                t0,d0 = self.waypoint_times[n-1], self.waypoint_dists[n-1]
+            t1,d1 = self.waypoint_times[n], self.waypoint_dists[n]
+            if self.waypoints[n][1].type == 'neutro':
+                neutro = t1-t
+            d = d0
+            if t1 > t0 and t > t0:
+                d = d0+(d1-d0)*(t-t0)/(t1-t0)
+            if target:
+                passos = (planilha.item_abs_dist(*target)-d)/planilha.PASSO
+        return TickerStatus(t, trecho, target, remaining, passos, neutro)
+
+    def mark(self, t):
+        """The user is passing a reference: drift to the nearest target"""
+        n = bisect.bisect_left(self.target_times, t)
+        near = [k for k in (n-1, n) if 0 <= k < len(self.targets)]
+        if not near:
+            return None
+        k = min(near, key=lambda k: abs(self.target_times[k]-t))
+        self.drift = t-self.target_times[k]
+        dbg('mark: %s, drift %.1f', self.targets[k][1].ref_id, self.drift)
+        return self.drift
+
+    def format(self, st):
+        if st.race_time < 0:
+            return u'largada em %s' % (planilha.format_time(int(-st.race_time)+1))
+        parts = [planilha.format_time(int(st.race_time))]
+        if st.trecho:
+            parts.append(u'T%d %d m/min' % (st.trecho.number, st.trecho.speed))
+        if st.neutro is not None:
+            parts.append(u'NEUTRO %ds' % (int(st.neutro)+1))
+        if st.target:
+            parts.append(u'próx. %s em %.1fs, %.1f passos' % (st.target[1].ref_id, st.remaining, st.passos))
+        else:
+            parts.append(u'fim')
+        if self.drift is not None:
+            parts.append(u'desvio %+.1fs' % (self.drift))
+        return u' | '.join(parts)
+
+    def show(self, text, last):
+        # redraw the line only when it changes
+        if text == last:
+            return
+        pad = max(len(last or u'')-len(text), 0)
+        self.out.write((u'\r'+text+u' '*pad).encode('utf-8'))
+        self.out.flush()
+
+    def run(self):
+        """Update the status until the end of the circuit. Returns the number of updates"""
+        ticks = 0
+        last = None
+        next_tick = self.clock()
+        while True:
+            now = self.clock()
+            t = now-self.start
+            text = self.format(self.status(t))
+            self.show(text, last)
+            last = text
+            ticks += 1
+            if t > self.end_time:
+                break
+
+            # fixed schedule: a late tick doesn't delay the next ones
+            next_tick += self.period
+            if next_tick < now:
+                next_tick = now+self.period
+            l = self.wait(next_tick-now)
+            if l is not None:
+                if l.strip() == 'q':
+                    break
+                self.mark(self.clock()-self.start)
+        self.out.write('\n')
+        self.out.flush()
+        return ticks
+
+def run_ticker(opts, items, start, out=None):
+    """The ticker output. 'start' is the start time, as returned by parse_start()"""
+    Ticker(list(items), start, out=out).run()
+
+# vim: et ts=4 sw=4:
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+#
+# Extração do texto das planilhas em PDF, mantendo o layout das páginas
+#
+
+import subprocess
+
+import enduroape.perf
+
+import logging
+logger = logging.getLogger('trilhape.pdftext')
+dbg = logger.debug
+
+
+FORMFEED = '\x0c'
+
+PDF_MAGIC = '%PDF-'
+PDF_MAGIC_LIMIT = 1024 # o cabeçalho pode vir depois de algum lixo, até 1024 bytes
+
+def is_pdf(fname):
+    """Check the PDF magic bytes, instead of running 'file'"""
+    f = open(fname, 'rb')
+    try:
+        return PDF_MAGIC in f.read(PDF_MAGIC_LIMIT)
+    finally:
+        f.close()
+
+class PdftotextExtractor:
+    """Extraction using 'pdftotext -layout'
+
+    The lines are generated as pdftotext writes them, so the pages can
+    be parsed while the next ones are extracted.
+    """
+    name = 'pdftotext'
+
+    def lines(self, fname):
+        enduroape.perf.count('spawn:pdftotext')
+        proc = subprocess.Popen(['pdftotext', '-enc', 'UTF-8', '-layout', fname, '-'], stdout=subprocess.PIPE)
+
+        # readline() instead of file iteration, that would read ahead
+        # and wait for a full buffer
+        for l in iter(proc.stdout.readline, ''):
+            yield unicode(l.rstrip('\n'), 'utf-8')
+
+        proc.wait()
+        if proc.returncode <> 0:
+            raise Exception('pdftotext retornou erro!')
+
+def layout_lines(chars, char_width=None, line_height=None):
+    """Place the characters of a page on a text grid, like 'pdftotext -layout'
+
+    'chars' is a list of (x0, y0, x1, y1, text) tuples, in PDF
+    coordinates (y grows upwards). The column of each character is its
+    x position divided by the character width (by default, the median
+    width of the characters), and vertical gaps become blank lines.
+    """
+    chars = [c for c in chars if c[4].strip()]
+    if not chars:
+        return []
+
+    if char_width is None:
+        widths = sorted(c[2]-c[0] for c in chars)
+        char_width = widths[len(widths)/2] or 1.0
+    if line_height is None:
+        heights = sorted(c[3]-c[1] for c in chars)
+        line_height = heights[len(heights)/2] or 1.0
+
+    # group the characters on rows, from the top of the page
+    chars.sort(key=lambda c: (-c[1], c[0]))
+    rows = []
+    for c in chars:
+        if rows and rows[-1][0]-c[1] < line_height/2:
+            rows[-1][1].append(c)
+        else:
+            rows.append( (c[1], [c]) )
+
+    left = min(c[0] for c in chars)
+    lines = []
+    last_y = None
+    for y,row in rows:
+        if last_y is not None:
+            for i in xrange(int(round((last_y-y)/line_height))-1):
+                lines.append(u'')
+        last_y = y
+
+        buf = []
+        for c in sorted(row):
+            col = max(int(round((c[0]-left)/char_width)), len(buf))
+            buf.extend(u' '*(col-len(buf)))
+            buf.append(c[4])
+        lines.append(u''.join(buf).rstrip())
+    return lines
+
+class PdfminerExtractor:
+    """Pure-Python extraction, using pdfminer
+
+    pdfminer is imported only when this extractor is used. The layout
+    is rebuilt from the character positions by layout_lines(), and the
+    pages are generated one at a time.
+    """
+    name = 'pdfminer'
+
+    def __init__(self):
+        try:
+            from pdfminer.pdfinterp import PDFResourceManager, PDFPageInterpreter
+            from pdfminer.converter import PDFPageAggregator
+            from pdfminer.layout import LAParams, LTChar
+            from pdfminer.pdfpage import PDFPage
+        except ImportError:
+            raise Exception("o extrator 'pdfminer' precisa do módulo pdfminer")
+
+        self.rsrcmgr = PDFResourceManager()
+        self.device = PDFPageAggregator(self.rsrcmgr, laparams=LAParams())
+        self.interpreter = PDFPageInterpreter(self.rsrcmgr, self.device)
+        self.get_pages = PDFPage.get_pages
+        self.LTChar = LTChar
+
+    def page_chars(self, layout):
+        todo = [layout]
+        while todo:
+            o = todo.pop()
+            if isinstance(o, self.LTChar):
+                yield (o.x0, o.y0, o.x1, o.y1, o.get_text())
+            elif hasattr(o, '__iter__'):
+                todo.extend(o)
+
+    def lines(self, fname):
+        f = open(fname, 'rb')
+        try:
+            for n,page in enumerate(self.get_pages(f)):
+                self.interpreter.process_page(page)
+                lines = layout_lines(list(self.page_chars(self.device.get_result())))
+                dbg('pdfminer: page %d: %d lines', n+1, len(lines))
+                if not lines:
+                    lines = [u'']
+                # pdftotext puts a form feed before each new page
+                if n > 0:
+                    lines[0] = FORMFEED+lines[0]
+                for l in lines:
+                    yield l
+        finally:
+            f.close()
+
+EXTRACTORS = {
+    'pdftotext': PdftotextExtractor,
+    'pdfminer': PdfminerExtractor,
+}
+
+_extractors = {}
+
+def get_extractor(name):
+    """Extractor instance, reused by all the files of the process"""
+    e = _extractors.get(name)
+    if e is None:
+        e = _extractors[name] = EXTRACTORS[name]()
+    return e
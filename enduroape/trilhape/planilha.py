@@ -25,15 +25,71 @@
 
 
 
-import sys, subprocess, re, optparse
+import sys, re, optparse, itertools, collections, array, math, os, time, tempfile, hashlib, cPickle
+import copy, StringIO, bisect, multiprocessing, multiprocessing.pool, json, marshal, threading, socket
 from Cheetah.Template import Template
+from Cheetah.Version import Version as CheetahVersion
 
 import enduroape.sound
+import enduroape.perf
+from enduroape.trilhape import pdftext
 
 import logging
 logger = logging.getLogger('trilhape.planilha')
 dbg = logger.debug
 
+# Tracing of the parser loops. The trace() calls are guarded by
+# 'if TRACE:', so they cost nothing when debug is off.
+TRACE = False
+TRACE_PAGES = None # números das páginas a mostrar, ou None para todas
+
+def set_trace(enabled, pages=None):
+    global TRACE, TRACE_PAGES
+    TRACE = enabled
+    TRACE_PAGES = pages
+
+def trace(page, line, fmt, *args):
+    """Debug message about a line of a page, filtered by TRACE_PAGES
+
+    'page' is the page number, or the list of page numbers of a group
+    (shown if any of them is on TRACE_PAGES). 'line' is always the line
+    number on the page (Page.lines, the group lines), counted from 0.
+    The sheet line numbers (e.g. item.sheet_line) are converted with
+    Page.sheet_line_number().
+    """
+    if isinstance(page, list):
+        if TRACE_PAGES is not None and not TRACE_PAGES.intersection(page):
+            return
+        page = '/'.join(page)
+    elif TRACE_PAGES is not None and page not in TRACE_PAGES:
+        return
+    logger.debug('[pag %s:%s] '+fmt, page, line, *args)
+
+def _item_page(item):
+    page = getattr(item, 'page', None)
+    if page is None:
+        page = getattr(item, 'p', None)
+    return getattr(page, 'number', None)
+
+def _item_line(item):
+    """Page line number of an item, for trace()"""
+    line = getattr(item, 'sheet_line', None)
+    page = getattr(item, 'page', None)
+    if line is None or page is None:
+        return None
+    return page.sheet_line_number(line)
+
+def parse_page_list(s):
+    """Parse a page list like '3,5-7'"""
+    pages = set()
+    for part in s.split(','):
+        if '-' in part:
+            first,last = part.split('-')
+            pages.update(str(n) for n in xrange(int(first), int(last)+1))
+        else:
+            pages.add(part.strip())
+    return pages
+
 
 FORMFEED ='\x0c'
 PASSO = 1.4
@@ -41,11 +97,68 @@ PASSO = 1.4
 class O:
     pass
 
-def pr(s, *args):
-    if args:
-        s = s % args
-    s = s.encode('utf-8')
-    print s
+OUTPUT_BUFFER = 256*1024 # caracteres acumulados antes de gravar a saída
+
+class OutputSink:
+    """Buffered output used by the formatters
+
+    The pieces (unicode, or UTF-8 str) are kept on a list and written
+    only when OUTPUT_BUFFER characters are collected, or on flush(),
+    encoded in a single step. The target is a file object ('out',
+    sys.stdout by default) or a file descriptor ('fd').
+
+    The formatters flush at each new page, so the output of the first
+    pages appears while the next ones are still being extracted.
+    """
+    def __init__(self, out=None, fd=None, bufsize=OUTPUT_BUFFER, encoding='utf-8'):
+        if out is None and fd is None:
+            out = sys.stdout
+        self.out = out
+        self.fd = fd
+        self.bufsize = bufsize
+        self.encoding = encoding
+        self.pieces = []
+        self.size = 0
+
+    def write(self, s):
+        self.pieces.append(s)
+        self.size += len(s)
+        if self.size >= self.bufsize:
+            self.flush()
+
+    def line(self, s):
+        self.pieces.append(s)
+        self.pieces.append(u'\n')
+        self.size += len(s)+1
+        if self.size >= self.bufsize:
+            self.flush()
+
+    def flush(self):
+        if not self.pieces:
+            return
+        try:
+            # ASCII str pieces are decoded by join()
+            text = u''.join(self.pieces)
+        except UnicodeDecodeError:
+            text = u''.join([p if isinstance(p, unicode) else unicode(p, self.encoding) for p in self.pieces])
+        data = text.encode(self.encoding)
+        del self.pieces[:]
+        self.size = 0
+        if self.fd is not None:
+            while data:
+                n = os.write(self.fd, data)
+                data = data[n:]
+        else:
+            self.out.write(data)
+            self.out.flush()
+
+class SinkTransaction:
+    """Cheetah transaction that makes respond() write to an OutputSink"""
+    def __init__(self, sink):
+        self.sink = sink
+
+    def response(self):
+        return self.sink
 
 def format_time(t):
     t_sec = t
@@ -57,36 +170,183 @@ def format_time(t):
     t_hour = int(t_min/60)
     return '%02d:%02d:%02d' % (t_hour, min, sec)
 
+# linhas que não são referências, mas que são esperadas na planilha
+EXPECTED_NONSTANDARD_LINES = [
+    u' *QUANDO +SEU +CRONÔMETRO',
+    u'DESLOCAMENTO',
+    u'PINUS COM FITAS',
+    u'^ *A EQUIPE TEM [0-9]+ MINUTOS',
+    u'^ *SUBIDA. TRANQUILAMENTE COM CUIDADO',
+    # fim da planilha em várias provas => instruções como chegar
+    u'^ *COMO CHEGAR (NO|AO|A|NA) '
+    # fim da planilha (05/2010)
+    u'^ *NO SITE DO CLUBE'
+]
+
+KEYWORDS = [
+    'esquerda',
+    ('em frente', 'frente'),
+    'direita',
+
+    'cuidado',
+    'perigo',
+    (u'aten[çc][ãa]o', 'atencao'),
+
+    ('lis[oa]', 'liso'),
+
+    ('sub(r|indo)',  'subir'),
+    ('desce(r|ndo)', 'descer'),
+
+    'rente',
+    'sentido',
+
+    'ponte',
+    'rio',
+    'tanque',
+    'porteira',
+    'trilha',
+    'cerca',
+    'estrada',
+    'mato',
+    'fitas',
+    'cima',
+    'baixo',
+    'barranco',
+    ('arames?', 'arame'),
+    ('buracos?', 'buraco'),
+    'banhado',
+    'torre',
+    'carreiro',
+    'cava',
+]
+
+def _any_of(patterns):
+    return u'|'.join(u'(?:%s)' % (p) for p in patterns)
+
+# Classificação das linhas da planilha: cada tipo de linha é um lookahead
+# opcional, de modo que um único match() no início da linha diz todos os
+# tipos aos quais ela pertence (com o mesmo resultado de um re.search()
+# para cada padrão)
+LINE_KINDS_RE = re.compile(u''.join(u'(?=%s|)' % (p) for p in [
+    u'(?P<trecho> *TRECHO +(?P<trecho_num>[0-9]+) *$)',
+    u'.*?(?P<velocidade>Velocidade Média *(?P<velocidade_num>[0-9]+) )',
+    u'(?P<neutralizado> *NEUTRALIZADO DE )',
+    u'.*?(?P<esperada>%s)' % (_any_of(EXPECTED_NONSTANDARD_LINES)),
+]), re.UNICODE)
+
+# uma única regexp para todas as palavras-chave. O nome do grupo
+# é o nome da palavra-chave
+def _keyword_group(kw):
+    if isinstance(kw, tuple):
+        regexp,kw = kw
+    else:
+        regexp = kw
+
+    # whole words only
+    return u'(?P<%s>\\b(?:%s)\\b)' % (kw, regexp)
+
+KEYWORDS_RE = re.compile(u'|'.join(_keyword_group(kw) for kw in KEYWORDS), re.UNICODE|re.I)
+
+REF_NUMBER_RE = re.compile('^ *([0-9]{3}) *$')
+REF_TIME_RE = re.compile('^ *([0-9]{2}):([0-9]{2}):([0-9]{2}) *$')
+TIME_RE = re.compile(u'([0-9]{2}):([0-9]{2}):([0-9]{2})')
+BLANK_RE = re.compile('^ *$')
+
+def check_keywords(text):
+    """Return the set of keywords found on 'text'"""
+    return set(str(m.lastgroup) for m in KEYWORDS_RE.finditer(text))
+
+class PageLimitError(Exception):
+    """The right margin of a page was not found"""
+    def __init__(self, page, candidates):
+        Exception.__init__(self, "I don't know where is the right margin of page %s (%r?)" % (page.number, candidates))
+        self.page = page
+        self.candidates = candidates
+
+# str.translate() table: ' ' -> '0', anything else -> '1'
+_occupancy_table = ''.join(c == ' ' and '0' or '1' for c in map(chr, xrange(256)))
+
+# distâncias, a partir do número da página, onde a margem direita é procurada
+PAGE_LIMIT_CANDIDATES = (5,6,4,7,3,8,2,9)
+
+# número de colunas em branco a partir do qual a divisão é considerada segura
+PAGE_LIMIT_GAP = 3
+
+class PageLines(object):
+    """Lines of a page: a view of columns left:right of the group lines
+
+    The lines are sliced only when used, padded with spaces to the
+    same width.
+    """
+    __slots__ = ('lines', 'left', 'right', 'size')
+
+    def __init__(self, lines, left, right, size):
+        self.lines = lines
+        self.left = left
+        self.right = right
+        self.size = size
+
+    def __len__(self):
+        return len(self.lines)
+
+    def __getitem__(self, i):
+        return self.lines[i][self.left:self.right].ljust(self.size)
+
+    def __iter__(self):
+        left,right,size = self.left,self.right,self.size
+        for l in self.lines:
+            yield l[left:right].ljust(size)
+
 class Group:
     def find_width(self):
-        width = max([len(l) for l in self.lines])
-        for i,l in enumerate(self.lines):
-            self.lines[i] = l.ljust(width+3)
-        self.width = width
+        """Find the group width and the column occupancy profile
 
-    def can_divide(self, end):
-        """Check if the colun at 'end' is filled with spaces"""
-        if end >= self.width:
-            return True
+        self.blank[c] is 1 if column 'c' is blank on all lines.
+        """
+        self.width = max([len(l) for l in self.lines])
 
+        # bitmap of the non-blank columns of all lines
+        occupied = 0
         for l in self.lines:
-            #dbg("l[%d]: %r", end, l[end])
-            if l[end] <> ' ':
-                return False
-        return True
+            if l:
+                # 'replace' keeps one byte per character, so the
+                # columns don't change
+                bits = l.encode('latin-1', 'replace').translate(_occupancy_table)
+                occupied |= int(bits[::-1], 2)
+
+        self.blank = bytearray(self.width+1)
+        for c in xrange(self.width+1):
+            if not (occupied >> c) & 1:
+                self.blank[c] = 1
+
+    def can_divide(self, end):
+        """Check if the colun at 'end' is filled with spaces"""
+        return end >= self.width or self.blank[end]
+
+    def blank_gap(self, end):
+        """Number of blank columns around column 'end'"""
+        start = end
+        while start > 0 and self.can_divide(start-1):
+            start -= 1
+        stop = end
+        while stop < self.width and self.can_divide(stop):
+            stop += 1
+        return max(stop-start, 1)
 
     def find_page_limits(self):
         previous = 0
         for p in self.pages:
-            ok = False
-            for n in (5,6,4,7,3,8,2,9):
-                end = p.min_right+n
+            candidates = [p.min_right+n for n in PAGE_LIMIT_CANDIDATES]
+            for end in candidates:
                 if self.can_divide(end):
-                    ok = True
                     break
+            else:
+                raise PageLimitError(p, candidates)
 
-            if not ok:
-                raise Exception("I don't know where is the right margin of page %s (%d?)" % (p.number, end))
+            # a wide blank gap means a safe split
+            p.limit_confidence = min(1.0, float(self.blank_gap(end))/PAGE_LIMIT_GAP)
+            if p.limit_confidence < 1.0:
+                logger.info('page %s: right margin at column %d, confidence %.2f', p.number, end, p.limit_confidence)
 
             dbg("page columns: %d:%d", previous, end)
             p.left = previous
@@ -94,25 +354,47 @@ class Group:
             previous = end
 
         for p in self.pages:
-            p.lines = [l[p.left:p.right] for l in self.lines]
+            p.lines = PageLines(self.lines, p.left, p.right, min(p.right, self.width+3)-p.left)
 
-class CircuitoItem:
-    """Um item no circuito (não necessariamente presente na planilha"""
-    def __init__(self, **kwargs):
-        self.__dict__.update(**kwargs)
+# cache of the normalized type names used on is_a()
+_type_keys = {}
 
-    @property
-    def type(self):
-        return self.__class__.__name__.lower()
+class CircuitoItem(object):
+    """Um item no circuito (não necessariamente presente na planilha
+
+    Subclasses define 'type' (the lowercase class name) and list the
+    item properties on __slots__.
+    """
+    __slots__ = ()
+    type = None
+
+    def __init__(self, **kwargs):
+        for k,v in kwargs.items():
+            setattr(self, k, v)
 
     def is_a(self, t):
         """Shortcut for checking the item class"""
-        return self.type.lower() == str(t).lower()
+        k = _type_keys.get(t)
+        if k is None:
+            k = _type_key(t)
+        return self.type == k
+
+    def properties(self):
+        """Returns a dictionary with the properties that are set"""
+        d = {}
+        for c in self.__class__.__mro__:
+            for k in getattr(c, '__slots__', ()):
+                if hasattr(self, k):
+                    d[k] = getattr(self, k)
+        return d
 
 
 # nova página da planilha
 # propriedades: 'number'
 class NewPage(CircuitoItem):
+    __slots__ = ('p',)
+    type = 'newpage'
+
     def __init__(self, p):
         self.p = p
 
@@ -123,13 +405,15 @@ class NewPage(CircuitoItem):
 
 class PageItem(CircuitoItem):
     """Um item na planilha"""
+    __slots__ = ('page', 'sheet_line')
+
     def __init__(self, page, sheet_line, **kwargs):
         self.page = page
         self.sheet_line = sheet_line
-        self.__dict__.update(kwargs)
+        CircuitoItem.__init__(self, **kwargs)
 
     def __repr__(self):
-        return '<%s: %r>' % (self.__class__, self.__dict__)
+        return '<%s.%s: %r>' % (self.__class__.__module__, self.__class__.__name__, self.properties())
 
     def add_sidenote(self, msg, offset=0):
         self.page.add_sheet_sidenote(self.sheet_line+offset, msg)
@@ -147,8 +431,13 @@ class PageItem(CircuitoItem):
 class Referencia(PageItem):
     """Referência
 
-    properties: abs_dist, rel_dist, abs_time, rel_passos, ref_index, ref_id
+    properties: rel_dist, abs_time, rel_time, rel_passos, ref_index, ref_id,
+    sheet_abs_dist, keywords
     """
+    __slots__ = ('rel_dist', 'abs_time', 'rel_time', 'rel_passos', 'ref_index',
+                 'sheet_abs_dist', 'keywords')
+    type = 'referencia'
+
     @property
     def ref_id(self):
         return str(self.ref_index)
@@ -156,8 +445,13 @@ class Referencia(PageItem):
 class Parcial(CircuitoItem):
     """Uma parcial
 
-    properties: abs_dist, rel_dist, abs_time, rel_passos, ref_id
+    properties: abs_dist, rel_dist, abs_time, rel_time, rel_passos, ref_id,
+    ref_before, ref_after, parcial_index
     """
+    __slots__ = ('abs_dist', 'rel_dist', 'abs_time', 'rel_time', 'rel_passos',
+                 'ref_before', 'ref_after', 'parcial_index')
+    type = 'parcial'
+
     @property
     def ref_id(self):
         return '%d.%d' % (self.ref_before.ref_index, self.parcial_index)
@@ -165,9 +459,11 @@ class Parcial(CircuitoItem):
 class Neutro(PageItem):
     """Neutro
 
-    properties: abs_time, rel_dist(==0), ref_index, ref_id
+    properties: abs_time, rel_dist(==0), rel_time, rel_passos, ref_index, ref_id
     """
-    pass
+    __slots__ = ('abs_time', 'rel_dist', 'rel_time', 'rel_passos', 'ref_index')
+    type = 'neutro'
+
     @property
     def ref_id(self):
         return str(self.ref_index)
@@ -175,9 +471,10 @@ class Neutro(PageItem):
 class NovoTrecho(PageItem):
     """Novo trecho do circuito
 
-    properties: number, speed
+    properties: number, speed, steps_bpm
     """
-    pass
+    __slots__ = ('number', 'speed', 'steps_bpm')
+    type = 'novotrecho'
 
 class Page:
     def __init__(self, g):
@@ -192,24 +489,35 @@ class Page:
     def width(self):
         return self.right-self.left
 
-    def col_lines(self, col):
+    def sheet_lines(self):
+        """Lines of the sheet table, after the header
+
+        Sheet line 'i' is page line self.sheet_line_number(i).
+        """
+        return itertools.islice(self.lines, self.sheet_start, None)
+
+    def sheet_line_number(self, i):
+        """Convert a sheet line number to a page line number"""
+        return self.sheet_start+i
+
+    def col_limit(self, col):
+        """Returns the (start, end) columns of table column 'col'"""
         limits = self.col_limits[:]
         limits.append(self.width)
+        return limits[col],limits[col+1]
 
-        start = limits[col]
-        end = limits[col+1]
-        for l in self.sheet_lines:
+    def col_lines(self, col):
+        start,end = self.col_limit(col)
+        for l in self.sheet_lines():
             yield l[start:end]
 
     def add_sidenote(self, i, note):
-        dbg('page %s. sidenote %d: %s', self.number, i, note)
+        if TRACE:
+            trace(self.number, i, 'sidenote: %s', note)
         self.sidenotes.setdefault(i, []).append(note)
 
     def add_sheet_sidenote(self, i, note):
-        #XXX: this is a bit fragile, but it should work:
-        offset = len(self.lines)-len(self.sheet_lines)
-
-        self.add_sidenote(i+offset, note)
+        self.add_sidenote(self.sheet_line_number(i), note)
 
     def sheet_warn(self, i, fmt, *args):
         msg = fmt % args
@@ -220,63 +528,19 @@ class Page:
         """Returns an iterator on the items on the sheet page
         """
 
-        EXPECTED_NONSTANDARD_LINES = [
-            u' *QUANDO +SEU +CRONÔMETRO',
-            u'DESLOCAMENTO',
-            u'PINUS COM FITAS',
-            u'^ *A EQUIPE TEM [0-9]+ MINUTOS',
-            u'^ *SUBIDA. TRANQUILAMENTE COM CUIDADO',
-            # fim da planilha em várias provas => instruções como chegar
-            u'^ *COMO CHEGAR (NO|AO|A|NA) '
-            # fim da planilha (05/2010)
-            u'^ *NO SITE DO CLUBE'
-        ]
-
-        KEYWORDS = [
-            'esquerda',
-            ('em frente', 'frente'),
-            'direita',
-
-            'cuidado',
-            'perigo',
-            (u'aten[çc][ãa]o', 'atencao'),
-
-            ('lis[oa]', 'liso'),
-
-            ('sub(r|indo)',  'subir'),
-            ('desce(r|ndo)', 'descer'),
-
-            'rente',
-            'sentido',
-
-            'ponte',
-            'rio',
-            'tanque',
-            'porteira',
-            'trilha',
-            'cerca',
-            'estrada',
-            'mato',
-            'fitas',
-            'cima',
-            'baixo',
-            'barranco',
-            ('arames?', 'arame'),
-            ('buracos?', 'buraco'),
-            'banhado',
-            'torre',
-            'carreiro',
-            'cava',
-        ]
-
-        self.sheet_lines = self.lines[:]
+        # the sheet table starts after the lines skipped below
+        self.sheet_start = 0
 
         def match(pat):
-            dbg("match: %r. next line: %r", pat, self.sheet_lines[0])
-            m = re.search(pat, self.sheet_lines[0])
+            line = self.lines[self.sheet_start]
+            if TRACE:
+                trace(self.number, self.sheet_start, "match: %r. next line: %r", pat, line)
+            m = re.search(pat, line)
             if m:
-                dbg('match: %r %r', m, self.sheet_lines[0])
-                return m,self.sheet_lines.pop(0)
+                if TRACE:
+                    trace(self.number, self.sheet_start, 'match: %r %r', m, line)
+                self.sheet_start += 1
+                return m,line
 
         def skip(pat):
             while match(pat):
@@ -344,7 +608,8 @@ class Page:
                 state.cur_time = 0
 
             if state.cur_relative is not None and state.cur_time is not None and state.cur_abs is not None:
-                dbg("got new reference")
+                if TRACE:
+                    trace(self.number, self.sheet_line_number(state.last_ref_data_line), "got new reference")
                 # i-1 because the item ended on the previous line
                 keywords = check_keywords('\n'.join(state.ref_lines))
 
@@ -375,11 +640,12 @@ class Page:
 
         def check_ref_col0_data(l):
             # the previous item may have finished:
-            m = re.search('^ *([0-9]{3}) *$', l)
+            m = REF_NUMBER_RE.search(l)
             if m:
                 referencia_finish()
                 if state.cur_relative is None:
-                    dbg('got state.cur_rel')
+                    if TRACE:
+                        trace(self.number, self.sheet_line_number(i), 'got state.cur_rel')
                     # termina a referência anterior para que possa ser retornada
                     referencia_finish()
 
@@ -389,13 +655,14 @@ class Page:
                     return True
 
             if state.cur_time is None:
-                m = re.search('^ *([0-9]{2}):([0-9]{2}):([0-9]{2}) *$', l)
+                m = REF_TIME_RE.search(l)
                 if m:
                     h,m,s = [int(s) for s in m.groups()]
                     assert 0 <= h
                     assert 0 <= m < 60
                     assert 0 <= s < 60
-                    dbg('got state.cur_time')
+                    if TRACE:
+                        trace(self.number, self.sheet_line_number(i), 'got state.cur_time')
                     # termina a referência anterior para que possa ser retornada
                     referencia_finish()
 
@@ -405,38 +672,27 @@ class Page:
                     return True
 
             if state.cur_relative is not None and (state.cur_time is not None or state.cur_relative == 0) and state.cur_abs is None:
-                m = re.search('^ *([0-9]{3}) *$', l)
+                m = REF_NUMBER_RE.search(l)
                 if m:
                     state.cur_abs = int(m.group(1))
                     state.last_ref_data_line = i
                     state.inside_ref = True
-                    dbg('got state.cur_abs')
+                    if TRACE:
+                        trace(self.number, self.sheet_line_number(i), 'got state.cur_abs')
                     return True
 
-        def check_keywords(line):
-            keywords = []
-            for kw in KEYWORDS:
-                if isinstance(kw, tuple):
-                    regexp,kw = kw
-                else:
-                    regexp = kw
-
-                # whole words only
-                regexp = r'\b%s\b' % (regexp)
-                if re.search(regexp, line, re.UNICODE|re.I):
-                    keywords.append(kw)
-            return set(keywords)
-
-        for i,l in enumerate(self.col_lines(0)):
+        col_start,col_end = self.col_limit(0)
+        for i,full_line in enumerate(self.sheet_lines()):
             for r in flush_items():
                 yield r
 
-            full_line = self.sheet_lines[i]
-            dbg('col: %r', l)
-            dbg('full line: %r', full_line)
+            l = full_line[col_start:col_end]
+            if TRACE:
+                trace(self.number, self.sheet_line_number(i), 'col: %r', l)
+                trace(self.number, self.sheet_line_number(i), 'full line: %r', full_line)
 
             if state.wait_neutro:
-                m = re.search(u'([0-9]{2}):([0-9]{2}):([0-9]{2})', full_line)
+                m = TIME_RE.search(full_line)
                 if m:
                     referencia_finish()
 
@@ -456,42 +712,40 @@ class Page:
                 # found ref data, no need to check the full_line info below
                 continue
 
-            m = re.search('^ *TRECHO +([0-9]+) *$', full_line)
-            if m:
+            kinds = LINE_KINDS_RE.match(full_line)
+            if kinds.group('trecho') is not None:
                 # início de trecho: reseta abs
-                state.num_trecho = int(m.group(1))
+                state.num_trecho = int(kinds.group('trecho_num'))
                 state.wait_speed = True
                 continue
 
-            m = re.search(u'Velocidade Média *([0-9]+) ', full_line)
-            if m:
+            if kinds.group('velocidade') is not None:
                 assert state.wait_speed
                 referencia_finish()
 
-                vel = int(m.group(1))
+                vel = int(kinds.group('velocidade_num'))
                 steps_bpm = (vel/PASSO)*2 # passadas (simples) por minuto
                 queue_item(NovoTrecho(self, i, number=state.num_trecho, speed=vel, steps_bpm=steps_bpm))
                 state.wait_speed = False
 
             #if re.search(r'^ *NEUTRALIZADO DE |CONTINUE A CAMINHADA QUANDO SEU', full_line):
-            if re.search(r'^ *NEUTRALIZADO DE ', full_line):
+            if kinds.group('neutralizado') is not None:
                 referencia_finish()
 
                 state.wait_neutro = True
                 continue
 
             line_ok = False
-            for n in EXPECTED_NONSTANDARD_LINES:
-                if re.search(n, full_line, re.UNICODE):
-                    referencia_finish()
-                    line_ok = True
+            if kinds.group('esperada') is not None:
+                referencia_finish()
+                line_ok = True
 
             if not state.inside_ref:
                 keywords = check_keywords(full_line)
                 if keywords:
                     self.sheet_warn(i, 'orphan keywords: %s', ', '.join(keywords))
 
-            m = re.search('^ *$', l)
+            m = BLANK_RE.search(l)
             if not m and not line_ok:
                 referencia_finish()
                 self.sheet_warn(i, 'unexpected line: %r', full_line)
@@ -502,23 +756,28 @@ class Page:
             yield r
 
 
-    def show(self, opts):
-        pr('+%s+' % ('-'*self.width))
+    def show(self, opts, sink=None):
+        own_sink = sink is None
+        if own_sink:
+            sink = OutputSink()
+        w = sink.line
+        w('+%s+' % ('-'*self.width))
         for i,l in enumerate(self.lines):
             notes = ''
             if i in self.sidenotes:
                 notes = ' %s' % (' / '.join(self.sidenotes[i]))
-            pr('|%s|%s' % (l, notes))
-        pr('+%s+' % ('-'*self.width))
+            w('|%s|%s' % (l, notes))
+        w('+%s+' % ('-'*self.width))
+        if own_sink:
+            sink.flush()
 
 def split_groups(lines):
+    """Generate the page groups, as soon as the last line of each one is read"""
     re_pag = re.compile(u'Página +([A-Z]*)([0-9]+)', re.UNICODE)
 
-    groups = []
-    cur = []
     def newpage(matches):
         g = Group()
-        g.lines = cur[:]
+        g.lines = cur
         g.pages = []
         for m in matches:
             p = Page(g)
@@ -526,17 +785,26 @@ def split_groups(lines):
             p.number = '%s%s' % (m.group(1), m.group(2))
             g.pages.append(p)
 
+        return g
 
-        groups.append(g)
-
-        cur[:] = []
+    # the page numbers are on the last line of the group, so the trace
+    # messages of the group are kept until they are known
+    group_trace = []
+    def flush_trace(matches):
+        numbers = ['%s%s' % (m.group(1), m.group(2)) for m in matches]
+        for line,fmt,args in group_trace:
+            trace(numbers, line, fmt, *args)
+        del group_trace[:]
 
+    cur = []
+    ngroups = 0
     lastletter = None
     lastpage = 0
     for l in lines:
-        dbg("line: %r", l)
+        if TRACE:
+            group_trace.append( (len(cur), "line: %r", (l,)) )
         # expect to find a form feed char after each page:
-        if len(cur) == 0 and len(groups) > 0:
+        if len(cur) == 0 and ngroups > 0:
             assert l.startswith(FORMFEED)
             l = l.replace(FORMFEED, '')
 
@@ -546,26 +814,30 @@ def split_groups(lines):
         if not matches:
             continue
 
-        dbg('%r', texts)
+        if TRACE:
+            group_trace.append( (len(cur)-1, '%r', (texts,)) )
 
         if len(matches) > 3:
+            if TRACE:
+                flush_trace(matches)
             raise Exception('unexpected matches: %r' % (texts))
 
         letter = matches[0].group(1)
         pag = int(matches[0].group(2))
-        dbg('letter: %r. pag: %r', letter, pag)
-        dbg('last: %r %r', lastletter, lastpage)
+        if TRACE:
+            group_trace.append( (len(cur)-1, 'letter: %r. pag: %r. last: %r %r', (letter, pag, lastletter, lastpage)) )
+            flush_trace(matches)
         if (letter <> lastletter and pag == 1) or \
            (letter == lastletter and pag == lastpage+1):
-           newpage(matches)
+            yield newpage(matches)
+            ngroups += 1
+            cur = []
         else:
             raise Exception('unexpected matches: %r. %r %r' % (texts, letter, pag))
 
         lastletter = matches[-1].group(1)
         lastpage = int(matches[-1].group(2))
 
-    return groups
-
 
 def _parse_pages(pages):
     for p in pages:
@@ -575,23 +847,44 @@ def _parse_pages(pages):
         try:
             yield NewPage(p)
             for i in p.parse_sheet():
-                dbg('sheet item: %r', i)
+                if TRACE:
+                    trace(p.number, _item_line(i), 'sheet item: %r', i)
                 yield i
-        except:
+        except Exception:
             sys.stderr.write('FATAL: erro parseando pagina %s\n' % (p.number))
             raise
 
 def msec_to_mmin(v):
     return v*60
 
+STATE_FIELDS = ['abs_dist', 'abs_time', 'prev_abs_time', 'trecho_dist', 'trecho_time',
+                'last_ref', 'last_ref_index', 'previous_state',
+                'sheet_abs_dist', 'speed', 'last_trecho_num', 'cur_trecho']
+
+class CircuitoSnapshot(collections.namedtuple('CircuitoSnapshot', STATE_FIELDS)):
+    """Immutable copy of the CircuitoState fields
+
+    The objects (last_ref, cur_trecho, previous_state) are shared,
+    not copied.
+    """
+    __slots__ = ()
+
+    @property
+    def abs_time_str(self):
+        """Formatted abs_time"""
+        return format_time(self.abs_time)
+
+def check_t_delta(t_delta, prev_abs_time, last_ref):
+    # assert t_delta >= 0
+    # assert (t_delta > 0) or (prev_abs_time == 0) or isinstance(last_ref, Neutro)
+    if t_delta < 0:
+        logger.error("negative t_delta! (just after ref: %r)", last_ref)
+    if t_delta == 0 and not ((prev_abs_time == 0) or isinstance(last_ref, Neutro)):
+        logger.error("unexpected zero t_delta (just after ref: %r)", last_ref)
+
 class CircuitoState:
     """Keep track of the current state of sheet parsing"""
-    def __init__(self, orig=None):
-        if orig is not None:
-            # copy data
-            self.__dict__.update(orig.__dict__)
-            return
-
+    def __init__(self):
         self.abs_dist = 0
         self.abs_time = 0
         self.prev_abs_time = None
@@ -601,21 +894,33 @@ class CircuitoState:
         # last_ref: última Referencia ou Neutro
         self.last_ref = None
         self.last_ref_index = 0
+        self.previous_state = None
+
+        # keep track of the abs_dist data from the sheet, but
+        # it is reset randomly, so probably it can be ignored
+        self.sheet_abs_dist = 0
+        self.speed = None
+        self.last_trecho_num = 0
+        self.cur_trecho = None
 
     @property
     def abs_time_str(self):
         """Formatted abs_time"""
         return format_time(self.abs_time)
 
-    def copy(self):
-        return CircuitoState(self)
+    def snapshot(self):
+        """Returns an immutable copy of the current state"""
+        return CircuitoSnapshot(self.abs_dist, self.abs_time, self.prev_abs_time,
+                                self.trecho_dist, self.trecho_time,
+                                self.last_ref, self.last_ref_index, self.previous_state,
+                                self.sheet_abs_dist, self.speed, self.last_trecho_num,
+                                self.cur_trecho)
 
     def add_dist(self, rel_dist):
         self.trecho_dist += rel_dist
         self.abs_dist += rel_dist
 
     def add_time(self, rel_time):
-        dbg("add_time: %d", rel_time)
         self.trecho_time += rel_time
 
     def reset_trecho(self):
@@ -628,21 +933,18 @@ class CircuitoState:
 
         t_delta = self.abs_time - self.prev_abs_time
 
-        dbg('update_abs_time: abs_time %r, prev_abs_time %r, t_delta %r, last_ref %r', self.abs_time, self.prev_abs_time, t_delta, self.last_ref)
-        # assert t_delta >= 0
-        # assert (t_delta > 0) or (self.prev_abs_time == 0) or isinstance(self.last_ref, Neutro)
-        if t_delta < 0:
-            logger.error("negative t_delta! (just after ref: %r)", self.last_ref)
-        if t_delta == 0 and not ((self.prev_abs_time == 0) or isinstance(self.last_ref, Neutro)):
-            logger.error("unexpected zero t_delta (just after ref: %r)", self.last_ref)
+        if TRACE:
+            trace(_item_page(self.last_ref), _item_line(self.last_ref),
+                  'update_abs_time: abs_time %r, prev_abs_time %r, t_delta %r', self.abs_time, self.prev_abs_time, t_delta)
+        check_t_delta(t_delta, self.prev_abs_time, self.last_ref)
         self.add_time(t_delta)
         return t_delta
 
     def _new_ref(self, ref):
-        # throw away the previous reference so it is not copied
+        # throw away the previous reference so it is not kept
         self.previous_state = None
         # make a copy of current state and store it
-        self.previous_state = self.copy()
+        self.previous_state = self.snapshot()
 
         t_delta = self.update_abs_time(ref.abs_time)
         ref.rel_time = t_delta
@@ -659,83 +961,161 @@ class CircuitoState:
 
     @staticmethod
     def posicoes_parciais(passos):
-        # algoritmo:
-        # - gera 1 parciais de 5, 10, 20, e 30 passos para
-        #   pegar 'feeling' da velocidade
-        # - gera parciais de MAX_PARCIAL passos até chegar a 30 passos do final
-        # - parciais a 30,20,10 e 5 passos do final
+        return posicoes_parciais(passos)
+
+    def gera_parciais(self, estrategia=None):
+        prev = self.previous_state
+
+        if TRACE:
+            trace(_item_page(self.last_ref), _item_line(self.last_ref), "gera_parciais: ref %s", self.last_ref.ref_id)
+
+        if estrategia is None:
+            estrategia = ESTRATEGIAS_PARCIAIS[ESTRATEGIA_PADRAO]
+
+        # the sheet is parsed as it is read, so only the partials of this
+        # reference are known here (see TemplateNamespace.parciais)
+        dists,times = TabelaParciais.parciais(estrategia, prev.abs_dist, prev.abs_time, self.abs_dist, self.abs_time)
+        for k,(rel_dist,abs_time) in enumerate(zip(dists, times)):
+            rel_time = abs_time-prev.abs_time
+            parcial = Parcial(abs_time=abs_time, abs_dist=prev.abs_dist+rel_dist,
+                              rel_time=rel_time, rel_dist=rel_dist,
+                              rel_passos=rel_dist/PASSO,
+                              ref_before=prev.last_ref, ref_after=self.last_ref,
+                              parcial_index=k+1)
+
+            # the previous state, updated according to the partial data
+            check_t_delta(rel_time, prev.abs_time, prev.last_ref)
+            st = prev._replace(abs_time=abs_time, prev_abs_time=prev.abs_time,
+                               trecho_time=prev.trecho_time+rel_time,
+                               last_ref=parcial, previous_state=prev)
+            yield st,parcial
+
+class EstrategiaParciais:
+    """Estratégia de posicionamento das parciais
+
+    - gera 1 parcial em cada posição de 'begin_marks' (até a metade da
+      referência) para pegar 'feeling' da velocidade
+    - gera parciais a cada 'max_parcial' passos até chegar perto do final
+    - gera parciais nas posições de 'end_marks' contadas a partir do
+      final (o primeiro item é apenas referência para o intervalo)
+
+    As posições calculadas são memorizadas, pois muitas referências
+    têm a mesma distância.
+    """
+    def __init__(self, nome, descricao, max_parcial, begin_marks, end_marks, min_passos=10):
+        self.nome = nome
+        self.descricao = descricao
+        self.max_parcial = max_parcial
+        self.begin_marks = begin_marks
+        self.end_marks = end_marks
+        self.min_passos = min_passos
+        self._tabela = {}
 
-        dbg("posicoes_parciais: %d passos", passos)
+    def __repr__(self):
+        return '<EstrategiaParciais: %s>' % (self.nome)
 
-        MAX_PARCIAL = 10
-        BEGIN_MARKS = (5, 10, 20, 30)
-        #END_MARKS = (40, 30,20,10,5) # the first item is just for reference
-        END_MARKS = (10, 5) # the first item is just for reference
+    def posicoes(self, passos):
+        """Posições (em passos) das parciais para uma referência a 'passos' passos"""
+        r = self._tabela.get(passos)
+        if r is None:
+            r = self._tabela[passos] = tuple(self._calcula(passos))
+        return r
 
-        if passos < 10:
-            return
+    def _calcula(self, passos):
+        if passos < self.min_passos:
+            return []
 
-        lp = 0
-        for p in BEGIN_MARKS:
-            dbg('beginning: %d', p)
+        r = []
+        for p in self.begin_marks:
             if p >= passos/2:
-                dbg('skipping %d', p)
                 break
-            yield p
-            lp = p
+            r.append(p)
 
-        p = lp+MAX_PARCIAL
-        dbg('new p: %d', p)
-        while p < passos-END_MARKS[1]:
-            yield p
-            lp = p
-            dbg('generated %d', lp)
-            p += MAX_PARCIAL
+        lp = 0
+        if r:
+            lp = r[-1]
+
+        # p < passos-end_marks[1] <=> p < ceil(passos-end_marks[1]), para p inteiro
+        r.extend(xrange(lp+self.max_parcial, int(math.ceil(passos-self.end_marks[1])), self.max_parcial))
+        if r:
+            lp = r[-1]
 
         # arredonda os trechos finais para múltiplos de 
-        precisao = END_MARKS[-1]
+        precisao = self.end_marks[-1]
         redondo = int((passos+float(precisao/2))/precisao)*precisao
 
-        dbg('redondo: %d', redondo)
-
-        prevs = END_MARKS[:-1]
-        nexts = END_MARKS[1:]
+        prevs = self.end_marks[:-1]
+        nexts = self.end_marks[1:]
         for prev,next in zip(prevs, nexts):
-            dbg('prev: %d, next: %d', prev, next)
             p = redondo-next
-            dbg("ending p: %r", p)
             interval = prev-next
             diff = p - lp
-            dbg('interval: %d, diff: %d', interval, diff)
             if diff >= interval/2 and p < passos:
-                dbg('returning p: %r', p)
-                yield p
+                r.append(p)
                 lp = p
 
+        return r
 
-    def gera_parciais(self):
-        prev = self.previous_state
-        rel_dist = self.abs_dist-prev.abs_dist
-        rel_time = self.abs_time-prev.abs_time
-        passos = float(rel_dist)/PASSO
+ESTRATEGIAS_PARCIAIS = {}
 
-        dbg("gera_parciais: ref %s", self.last_ref.ref_id)
+def _estrategia(*args, **kwargs):
+    e = EstrategiaParciais(*args, **kwargs)
+    ESTRATEGIAS_PARCIAIS[e.nome] = e
 
-        for i,p in enumerate(self.posicoes_parciais(passos)):
-            partial_dist = p*PASSO
-            partial_time = rel_time*(float(partial_dist)/rel_dist)
-            abs_time = prev.abs_time+partial_time
-            abs_dist = prev.abs_dist+partial_dist
+_estrategia('padrao', u'parciais a cada 10 passos', 10, (5, 10, 20, 30), (10, 5))
+_estrategia('densa', u'parciais a cada 5 passos', 5, (5, 10, 15, 20), (10, 5))
+_estrategia('esparsa', u'parciais a cada 20 passos', 20, (5, 10, 20, 40), (20, 10))
 
-            parcial = Parcial(abs_time=abs_time, abs_dist=abs_dist, rel_time=partial_time, rel_dist=partial_dist)
-            parcial.ref_before = prev.last_ref
-            parcial.ref_after = self.last_ref
-            parcial.parcial_index = i+1
+ESTRATEGIA_PADRAO = 'padrao'
 
-            # copy current state and update it according to the partial data
-            stcopy = prev.copy()
-            stcopy._new_ref(parcial)
-            yield stcopy,parcial
+def posicoes_parciais(passos):
+    """Posições das parciais, usando a estratégia padrão"""
+    return ESTRATEGIAS_PARCIAIS[ESTRATEGIA_PADRAO].posicoes(passos)
+
+class TabelaParciais:
+    """Parciais entre referências consecutivas, calculadas de uma só vez
+
+    'abs_dists' e 'abs_times' são as distâncias e tempos absolutos de
+    cada referência. Os dados de cada parcial ficam em arrays paralelos:
+    ref (índice da referência no fim da parcial), parcial_index,
+    abs_dist, abs_time, rel_dist e rel_time (relativos à referência
+    anterior). Os objetos Parcial não são criados aqui.
+    """
+    def __init__(self, abs_dists, abs_times, estrategia=None):
+        if estrategia is None:
+            estrategia = ESTRATEGIAS_PARCIAIS[ESTRATEGIA_PADRAO]
+
+        self.ref = array.array('l')
+        self.parcial_index = array.array('l')
+        self.abs_dist = array.array('d')
+        self.abs_time = array.array('d')
+        self.rel_dist = array.array('d')
+        self.rel_time = array.array('d')
+
+        for n in xrange(1, len(abs_dists)):
+            prev_dist = abs_dists[n-1]
+            prev_time = abs_times[n-1]
+            dists,times = self.parciais(estrategia, prev_dist, prev_time, abs_dists[n], abs_times[n])
+            if not dists:
+                continue
+
+            self.ref.extend([n]*len(dists))
+            self.parcial_index.extend(xrange(1, len(dists)+1))
+            self.rel_dist.extend(dists)
+            self.abs_dist.extend([prev_dist+d for d in dists])
+            self.abs_time.extend(times)
+            self.rel_time.extend([t-prev_time for t in times])
+
+    def __len__(self):
+        return len(self.abs_time)
+
+    @staticmethod
+    def parciais(estrategia, prev_dist, prev_time, abs_dist, abs_time):
+        """Distâncias (relativas) e tempos (absolutos) das parciais entre duas referências"""
+        rel_dist = abs_dist-prev_dist
+        rel_time = abs_time-prev_time
+        dists = [p*PASSO for p in estrategia.posicoes(float(rel_dist)/PASSO)]
+        return dists, [prev_time+rel_time*(float(d)/rel_dist) for d in dists]
 
 def parse_pages(opts, pages):
     """Generate state,item tuples
@@ -744,16 +1124,12 @@ def parse_pages(opts, pages):
     'state' contains the current state after handling the item.
     """
     st = CircuitoState()
-
-    # keep track of the abs_dist data from the sheet, but
-    # it is reset randomly, so probably it can be ignored
-    st.sheet_abs_dist = 0
-    st.speed = None
-    st.last_trecho_num = 0
+    estrategia = ESTRATEGIAS_PARCIAIS[opts.estrategia_parciais]
 
     #for p,(i,cur_relative,cur_time,cur_abs) in _parse_pages(pages):
     for item in _parse_pages(pages):
-        dbg('new item: %r', item)
+        if TRACE:
+            trace(_item_page(item), _item_line(item), 'new item: %r', item)
         if isinstance(item, Referencia):
             # update current state based on new data:
             st.new_ref(item)
@@ -789,7 +1165,7 @@ def parse_pages(opts, pages):
             item.add_sidenote('passos: %.1f' % (float(item.rel_dist)/PASSO), -1)
 
             if opts.parciais:
-                for s,p in st.gera_parciais():
+                for s,p in enduroape.perf.wrap('partials', st.gera_parciais(estrategia)):
                     yield s,p
 
         elif isinstance(item, Neutro):
@@ -810,13 +1186,16 @@ def parse_pages(opts, pages):
             raise Exception("Unexpected item class: %r" % (item))
 
         # copy current state and return it
-        s = st.copy()
-        dbg("last_ref: %s. abs_dist: %d", s.last_ref_index, s.abs_dist)
+        s = st.snapshot()
+        if TRACE:
+            trace(_item_page(item), _item_line(item), "last_ref: %s. abs_dist: %d", s.last_ref_index, s.abs_dist)
         yield s,item
 
 
-def format_html(items):
-    print '''
+def format_html(items, out=None):
+    sink = OutputSink(out)
+    w = sink.line
+    w('''
     <style>
         body {
            font-size: 133%;
@@ -870,13 +1249,15 @@ def format_html(items):
 
 
     </style>
-          '''
-    print '<table>'
+          ''')
+    w('<table>')
     colunas = 3
     row = 0
     for state,item in items:
-        if isinstance(item, NovoTrecho):
-            print '<tr class="trecho"><td colspan="%d">TRECHO <strong>%s</strong> (%d m/s)</td></tr>' % (colunas, item.number, item.speed)
+        if isinstance(item, NewPage):
+            sink.flush()
+        elif isinstance(item, NovoTrecho):
+            w('<tr class="trecho"><td colspan="%d">TRECHO <strong>%s</strong> (%d m/s)</td></tr>' % (colunas, item.number, item.speed))
         elif isinstance(item, Referencia) or isinstance(item, Parcial) or isinstance(item, Neutro):
             row += 1
 
@@ -910,68 +1291,820 @@ def format_html(items):
                 spassos = '%.1f' % (item.rel_passos)
 
             classes = ' '.join(classes)
-            print '<tr class="%s">' % (classes)
-            print '<td class="ref_id">%s</td>' % (item.ref_id)
-            print '<td class="tempo">%s</td>' % (state.abs_time_str)
-            print '<td class="passos">%s</td>' % (spassos)
-            print '</tr>'
-    print '</table>'
-
-def format_text(items):
+            w('<tr class="%s">' % (classes))
+            w('<td class="ref_id">%s</td>' % (item.ref_id))
+            w('<td class="tempo">%s</td>' % (state.abs_time_str))
+            w('<td class="passos">%s</td>' % (spassos))
+            w('</tr>')
+    w('</table>')
+    sink.flush()
+
+def format_text(items, out=None):
+    sink = OutputSink(out)
+    w = sink.line
     for state,item in items:
-        if isinstance(item, NovoTrecho):
-            print 'TRECHO %s - %d m/s' % (item.number, item.speed)
+        if isinstance(item, NewPage):
+            sink.flush()
+        elif isinstance(item, NovoTrecho):
+            w('TRECHO %s - %d m/s' % (item.number, item.speed))
         elif isinstance(item, Referencia) or isinstance(item, Parcial) or isinstance(item, Neutro):
-            print '%-5s %s %5.1f %5d' % (item.ref_id, state.abs_time_str, item.rel_passos, item.rel_dist)
+            w('%-5s %s %5.1f %5d' % (item.ref_id, state.abs_time_str, item.rel_passos, item.rel_dist))
+    sink.flush()
+
+def _type_key(t):
+    k = _type_keys.get(t)
+    if k is None:
+        k = _type_keys[t] = str(t).lower()
+    return k
+
+def item_abs_dist(state, item):
+    """Absolute distance of an item
+
+    The state of a Parcial keeps the distance of the previous
+    reference; the Parcial has its own abs_dist.
+    """
+    return getattr(item, 'abs_dist', state.abs_dist)
+
+# resumo de um trecho, calculado pelo CircuitoIndex
+TrechoResumo = collections.namedtuple('TrechoResumo', ['number', 'speed', 'steps_bpm',
+                                                       'start_time', 'end_time', 'duration',
+                                                       'dist', 'passos', 'referencias',
+                                                       'parciais', 'neutros', 'neutro_time'])
+
+class CircuitoIndex:
+    """Indexes over the (state, item) list of the circuit, built once
+
+    The items are grouped by type and by trecho, keeping the circuit
+    order, and the abs_time and abs_dist of each group are kept on
+    sorted arrays, for the range queries (bisect). The states of a
+    valid sheet never go back in time or distance; parse_pages()
+    logs an error when they do.
+
+    Items before the first trecho are on trecho 0.
+    """
+    def __init__(self, items):
+        self.items = list(items)
+        self.by_type = {}
+        self.by_trecho = collections.OrderedDict()
+        self.times = {}
+        self.dists = {}
+
+        all_times = self.times[None] = array.array('d')
+        all_dists = self.dists[None] = array.array('d')
+        trecho = 0
+        for s,i in self.items:
+            if i.type == 'novotrecho':
+                trecho = i.number
+            self.by_type.setdefault(i.type, []).append( (s,i) )
+            self.by_trecho.setdefault(trecho, []).append( (s,i) )
+            all_times.append(s.abs_time)
+            d = item_abs_dist(s, i)
+            all_dists.append(d)
+            self.times.setdefault(i.type, array.array('d')).append(s.abs_time)
+            self.dists.setdefault(i.type, array.array('d')).append(d)
+        self.by_type[None] = self.items
+
+        self.trechos = [self._resumo(n, l) for n,l in self.by_trecho.items() if n > 0]
+
+    def _resumo(self, number, items):
+        trecho = items[0][1]
+        start = items[0][0]
+        end = items[-1][0]
+        dist = item_abs_dist(*items[-1])-item_abs_dist(*items[0])
+        count = collections.defaultdict(int)
+        neutro_time = 0
+        for s,i in items:
+            count[i.type] += 1
+            if i.type == 'neutro':
+                neutro_time += i.rel_time
+        return TrechoResumo(number, trecho.speed, trecho.steps_bpm,
+                            start.abs_time, end.abs_time, end.abs_time-start.abs_time,
+                            dist, dist/PASSO,
+                            count['referencia'], count['parcial'], count['neutro'], neutro_time)
+
+    def of_type(self, type=None):
+        """Items of a type ('Referencia', 'parcial', etc), or all the items"""
+        if not type:
+            return self.items
+        type = _type_key(type)
+        return self.by_type.get(type, [])
+
+    def trecho(self, number):
+        """Items of trecho 'number', starting with the NovoTrecho item"""
+        return self.by_trecho.get(number, [])
+
+    def _range(self, keys, type, start, end):
+        if type:
+            type = _type_key(type)
+        else:
+            type = None
+        k = keys.get(type)
+        if k is None:
+            return []
+        a = bisect.bisect_left(k, start)
+        b = len(k) if end is None else bisect.bisect_left(k, end)
+        return self.by_type[type][a:b]
+
+    def between(self, start, end=None, type=None):
+        """Items with start <= abs_time < end (in seconds)"""
+        return self._range(self.times, type, start, end)
+
+    def between_dist(self, start, end=None, type=None):
+        """Items with start <= abs_dist < end (in meters)"""
+        return self._range(self.dists, type, start, end)
+
+    def next_after(self, t, type='Referencia'):
+        """First item with abs_time > t, or None"""
+        type = _type_key(type)
+        k = self.times.get(type)
+        if k is None:
+            return None
+        n = bisect.bisect_right(k, t)
+        if n == len(k):
+            return None
+        return self.by_type[type][n]
+
+    def last_before(self, t, type='Referencia'):
+        """Last item with abs_time <= t, or None"""
+        type = _type_key(type)
+        k = self.times.get(type)
+        if k is None:
+            return None
+        n = bisect.bisect_right(k, t)
+        if n == 0:
+            return None
+        return self.by_type[type][n-1]
 
 class TemplateNamespace:
+    """Names available to the templates
+
+    'circuito' is the (state, item) list, or the items of a type with
+    circuito(type). 'indice' is the CircuitoIndex of the circuit, with
+    the range queries, and 'trechos' the TrechoResumo of each trecho.
+    The index is built on first use.
+    """
     def __init__(self, opts, items):
         self._opts = opts
         self._items = items
+        self._index = None
+        self._tabelas = {}
+
+    @property
+    def estrategia_parciais(self):
+        """EstrategiaParciais usada para calcular as parciais"""
+        return ESTRATEGIAS_PARCIAIS[self._opts.estrategia_parciais]
+
+    @property
+    def indice(self):
+        if self._index is None:
+            self._index = CircuitoIndex(self._items)
+        return self._index
+
+    @property
+    def trechos(self):
+        return self.indice.trechos
 
     def circuito(self, type=None):
-        for s,i in self._items:
-            if type and not i.is_a(type):
-                continue
-            yield s,i
+        return self.indice.of_type(type)
 
-def format_template(opts, items):
-    ns = TemplateNamespace(opts, items)
-    t = Template(file=opts.template_file, searchList=[ns])
-    r = t.respond()
-    logger.debug('reponse: %r', r)
-    sys.stdout.write(r.encode('utf-8'))
+    def parciais(self, estrategia=None):
+        """Parciais de todo o circuito, com a estratégia 'estrategia' (nome)
 
-def gen_sound(opts, items):
+        Calculadas de uma vez pela TabelaParciais, na primeira chamada,
+        mesmo sem -p. Os objetos Parcial são criados à medida que são
+        usados. A estratégia padrão é a do --parciais-estrategia.
+        """
+        if estrategia is None:
+            estrategia = self._opts and self._opts.estrategia_parciais or ESTRATEGIA_PADRAO
+        refs = [(s,i) for s,i in self.indice.items if i.type in ('referencia', 'neutro')]
+        t = self._tabelas.get(estrategia)
+        if t is None:
+            t = self._tabelas[estrategia] = TabelaParciais([s.abs_dist for s,i in refs],
+                                                           [s.abs_time for s,i in refs],
+                                                           ESTRATEGIAS_PARCIAIS[estrategia])
+        for k in xrange(len(t)):
+            rel_dist = t.rel_dist[k]
+            yield Parcial(abs_time=t.abs_time[k], abs_dist=t.abs_dist[k],
+                          rel_time=t.rel_time[k], rel_dist=rel_dist,
+                          rel_passos=rel_dist/PASSO,
+                          ref_before=refs[t.ref[k]-1][1], ref_after=refs[t.ref[k]][1],
+                          parcial_index=t.parcial_index[k])
+
+TEMPLATE_CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'enduroape', 'templates')
+
+class TemplateLoader:
+    """Cheetah templates compiled to Python classes, cached
+
+    Each template is compiled once per process. The compiled code is
+    also kept on 'cache_dir' (if not None), keyed by the template path,
+    mtime and size and the Cheetah and Python versions, so a changed
+    template is compiled again automatically.
+    """
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir
+        self.classes = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, path):
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        return path, repr((st.st_mtime, st.st_size, CheetahVersion, sys.version))
+
+    def get(self, path):
+        """Returns the template class for 'path'"""
+        key = self.key(path)
+        self.lock.acquire()
+        try:
+            cls = self.classes.get(key)
+            if cls is None:
+                cls = self.classes[key] = self._load(path, key)
+            return cls
+        finally:
+            self.lock.release()
+
+    def _load(self, path, key):
+        # the first part of the name identifies the template file, to
+        # remove the old versions
+        prefix = 'tmpl_%s_' % (hashlib.sha1(key[0]).hexdigest()[:12])
+        name = prefix+hashlib.sha1(key[1]).hexdigest()
+        fname = None
+        code = None
+        if self.cache_dir:
+            fname = os.path.join(self.cache_dir, '%s.code' % (name))
+            try:
+                f = open(fname, 'rb')
+                try:
+                    code = marshal.load(f)
+                finally:
+                    f.close()
+                self.hits += 1
+                dbg('template cache: hit %s', path)
+            except (IOError, EOFError, ValueError, TypeError):
+                code = None
+
+        if code is None:
+            self.misses += 1
+            dbg('template cache: compiling %s', path)
+            src = Template.compile(file=path, className=name, moduleName=name, returnAClass=False)
+            code = compile(src, path, 'exec')
+            if fname:
+                self._save(fname, prefix, code)
+
+        ns = {'__name__': name}
+        exec code in ns
+        return ns[name]
+
+    def _save(self, fname, prefix, code):
+        try:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            for n in os.listdir(self.cache_dir):
+                if n.startswith(prefix) and n.endswith('.code'):
+                    dbg('template cache: removing old %s', n)
+                    os.unlink(os.path.join(self.cache_dir, n))
+            fd,tmp = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+            f = os.fdopen(fd, 'wb')
+            marshal.dump(code, f)
+            f.close()
+            os.rename(tmp, fname)
+        except (IOError, OSError), e:
+            # the template still works, it just will be compiled again
+            logger.warn('template cache: %s', e)
+
+template_loader = TemplateLoader(TEMPLATE_CACHE_DIR)
+
+def format_template(opts, items, out=None, template_file=None):
+    if out is None:
+        out = sys.stdout
+    if template_file is None:
+        template_file = opts.template_file
+    ns = TemplateNamespace(opts, items)
+    t = template_loader.get(template_file)(searchList=[ns])
+    # the output is written as it is generated
+    sink = OutputSink(out)
+    t.respond(trans=SinkTransaction(sink))
+    sink.flush()
+
+def gen_sound(opts, items, soundfile=None):
+    if soundfile is not None:
+        opts = copy.copy(opts)
+        opts.soundfile = soundfile
     enduroape.sound.generate_soundtrack(opts, items)
 
-def mime_type(f):
-    proc = subprocess.Popen(['file', '-b', '--mime', f], stdout=subprocess.PIPE)
-    mime = proc.stdout.read()
-    proc.wait()
-    if proc.returncode <> 0:
-        raise Exception("commando 'file' retornou erro!")
+# tipos de saída: nome -> número de argumentos antes do arquivo
+OUTPUT_KINDS = {
+    'text': 0,
+    'html': 0,
+    'tmpl': 1,
+    'sound': 1,
+}
+
+def parse_output(spec):
+    """Parse a --out spec: KIND[:ARGS][:FILE]
+
+    Returns (kind, args, file). 'file' is '-' (stdout) if not given.
+    The sound output has only the file argument.
+    """
+    parts = spec.split(':')
+    kind = parts[0]
+    if kind not in OUTPUT_KINDS:
+        raise ValueError("tipo de saída desconhecido: %r" % (kind))
+    nargs = OUTPUT_KINDS[kind]
+    args = parts[1:1+nargs]
+    rest = parts[1+nargs:]
+    if len(args) < nargs or len(rest) > 1:
+        raise ValueError("especificação de saída inválida: %r" % (spec))
+    if kind == 'sound':
+        return kind, [], args[0]
+    if rest:
+        return kind, args, rest[0]
+    return kind, args, '-'
+
+def run_output(opts, items, output, out=None):
+    """Run one output (as returned by parse_output) over the items"""
+    enduroape.perf.call('output:%s' % (output[0]), _run_output, opts, items, output, out)
+
+def _run_output(opts, items, output, out):
+    kind,args,fname = output
+    if kind == 'sound':
+        gen_sound(opts, items, fname)
+        return
+    if kind == 'ticker':
+        # imported here: enduroape.ticker uses this module
+        from enduroape import ticker
+        ticker.run_ticker(opts, items, args[0], out)
+        return
+    if kind == 'cues':
+        from enduroape import cues
+        cues.run_server(opts, items, args[0], args[1], out)
+        return
+
+    f = None
+    if out is None:
+        if fname == '-':
+            out = sys.stdout
+        else:
+            out = f = open(fname, 'w')
+    try:
+        if kind == 'html':
+            format_html(items, out)
+        elif kind == 'tmpl':
+            format_template(opts, items, out, args[0])
+        else:
+            format_text(items, out)
+    finally:
+        if f is not None:
+            f.close()
+
+def run_outputs(opts, items, outputs):
+    """Generate all outputs from the same items
 
-    return mime.split('\n')[0].split(';')[0]
+    The text outputs run on a thread pool while the sound (that takes
+    much longer) is rendered. Outputs to stdout are kept on memory and
+    written in order at the end, so they are not mixed.
+    """
+    if len(outputs) == 1:
+        kind = outputs[0][0]
+        if kind in ('tmpl', 'sound'):
+            # templates may go through the items more than once
+            items = list(items)
+        run_output(opts, items, outputs[0])
+        return
+
+    items = list(items)
+    if enduroape.perf.current is not None:
+        # the profiler stages can't run on other threads
+        for o in outputs:
+            run_output(opts, items, o)
+        return
+
+    pool = multiprocessing.pool.ThreadPool(max(opts.jobs, 2))
+    results = []
+    for o in outputs:
+        if o[0] == 'sound':
+            continue
+        buf = None
+        if o[2] == '-':
+            buf = StringIO.StringIO()
+        results.append( (buf, pool.apply_async(run_output, (opts, items, o, buf))) )
+    pool.close()
+
+    for o in outputs:
+        if o[0] == 'sound':
+            run_output(opts, items, o)
+
+    for buf,r in results:
+        r.get()
+        if buf is not None:
+            sys.stdout.write(buf.getvalue())
+    pool.join()
+
+def read_lines(fname, extractor='pdftotext'):
+    """Generate the text lines of the sheet (PDF or text file), as they are read"""
+    if pdftext.is_pdf(fname):
+        for l in pdftext.get_extractor(extractor).lines(fname):
+            yield l
+        return
+
+    f = open(fname, 'r')
+    for l in f:
+        yield unicode(l.rstrip('\n'), 'utf-8')
+    f.close()
+
+def _find_limits(g):
+    g.find_width()
+    g.find_page_limits()
+
+def split_pages(lines):
+    """Generate the sheet pages, one group of pages at a time"""
+    for g in enduroape.perf.wrap('split_groups', split_groups(lines)):
+        dbg('new group: pages %r', [p.number for p in g.pages])
+        enduroape.perf.call('page_limits', _find_limits, g)
+        for p in g.pages:
+            yield p
+
+def keep_items(items, l):
+    """Append each item to 'l' as it is generated"""
+    for i in items:
+        l.append(i)
+        yield i
+
+SHEET_CACHE_VERSION = 2 # mude se o formato dos itens mudar, para invalidar o cache da planilha
+SHEET_CACHE_MAX_MB = 100
+SHEET_CACHE_MAX_DAYS = 30
+
+def _flatten_states(items):
+    """Replace the previous_state chains by indexes on a state table
+
+    The chain of previous_state objects is as long as the circuit,
+    and would be too deep for pickle.
+    """
+    index = {}
+    table = []
+    flat = []
+    for st,i in items:
+        # add the states not seen yet, the oldest first
+        chain = []
+        s = st
+        while s is not None and id(s) not in index:
+            chain.append(s)
+            s = s.previous_state
+        for s in reversed(chain):
+            prev = -1
+            if s.previous_state is not None:
+                prev = index[id(s.previous_state)]
+            index[id(s)] = len(table)
+            table.append(s._replace(previous_state=prev))
+        flat.append(index[id(st)])
+    return table, flat
+
+def _unflatten_states(table, flat):
+    states = []
+    for s in table:
+        prev = None
+        if s.previous_state >= 0:
+            prev = states[s.previous_state]
+        states.append(s._replace(previous_state=prev))
+    return [states[n] for n in flat]
+
+class MessageLog(logging.Handler):
+    """Keeps the (logger, level, message) of the warnings and errors"""
+    def __init__(self):
+        logging.Handler.__init__(self, logging.WARN)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append( (record.name, record.levelno, record.getMessage()) )
+
+class SheetCache:
+    """Cache of the parsed sheets, on a directory
+
+    The key is the hash of the file contents plus the options that
+    change the parsing result, so a repeated run doesn't need to run
+    'file', pdftotext or the parser. Entries are evicted by age and by
+    the total size of the directory.
+
+    The warnings and errors logged while parsing are kept with the
+    entry, and logged again when it is loaded.
+    """
+    def __init__(self, dir, max_bytes=SHEET_CACHE_MAX_MB*1024*1024, max_age=SHEET_CACHE_MAX_DAYS*24*3600):
+        self.dir = dir
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        if not os.path.isdir(dir):
+            os.makedirs(dir)
+
+    def key(self, fname, opts):
+        h = hashlib.sha1()
+        h.update(repr((SHEET_CACHE_VERSION, opts.parciais, opts.estrategia_parciais, opts.pdf_extractor)))
+        f = open(fname, 'rb')
+        for data in iter(lambda: f.read(1024*1024), ''):
+            h.update(data)
+        f.close()
+        return h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.dir, '%s.pickle' % (key))
+
+    def load(self, key):
+        """Returns (pages, items), or None if the sheet is not on the cache"""
+        fname = self.path(key)
+        try:
+            f = open(fname, 'rb')
+        except IOError:
+            dbg('sheet cache: miss %s', key)
+            return None
+
+        try:
+            pages,table,flat,items,messages = cPickle.load(f)
+        except Exception:
+            logger.warn('sheet cache: invalid entry %s', fname)
+            return None
+        finally:
+            f.close()
+
+        dbg('sheet cache: hit %s', key)
+        if messages:
+            logger.warn('sheet cache: results loaded from %s, messages of the original run:', fname)
+        for name,level,msg in messages:
+            logging.getLogger(name).log(level, '%s', msg)
+        # the file was just used, so it is the last to be evicted
+        os.utime(fname, None)
+        return pages, zip(_unflatten_states(table, flat), items)
+
+    def save(self, key, pages, items, messages=()):
+        table,flat = _flatten_states(items)
+        data = (pages, table, flat, [i for s,i in items], list(messages))
+
+        fd,tmp = tempfile.mkstemp(dir=self.dir, suffix='.tmp')
+        f = os.fdopen(fd, 'wb')
+        cPickle.dump(data, f, cPickle.HIGHEST_PROTOCOL)
+        f.close()
+        os.rename(tmp, self.path(key))
+        dbg('sheet cache: saved %s', key)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for n in os.listdir(self.dir):
+            if not n.endswith('.pickle'):
+                continue
+            fname = os.path.join(self.dir, n)
+            st = os.stat(fname)
+            entries.append( (st.st_mtime, st.st_size, fname) )
+        entries.sort()
+
+        total = sum(size for mtime,size,fname in entries)
+        now = time.time()
+        for mtime,size,fname in entries:
+            if now-mtime <= self.max_age and total <= self.max_bytes:
+                break
+            dbg('sheet cache: evicting %s', fname)
+            os.unlink(fname)
+            total -= size
+
+def process_sheet(opts, fname, outputs):
+    """Parse one sheet and generate the outputs
+
+    Returns the list of pages, if opts.show_pages is set.
+    """
+    shown_pages = None
+    cache = None
+    cached = None
+    if opts.cache_dir:
+        cache = SheetCache(opts.cache_dir, opts.cache_max_size*1024*1024, opts.cache_max_age*24*3600)
+        key = cache.key(fname, opts)
+        cached = enduroape.perf.call('cache', cache.load, key)
+
+    if cached:
+        shown_pages,items = cached
+    else:
+        lines = enduroape.perf.wrap('extraction', read_lines(fname, opts.pdf_extractor))
+        pages = split_pages(lines)
+        if opts.show_pages or cache:
+            shown_pages = []
+            pages = keep_items(pages, shown_pages)
+
+        items = enduroape.perf.wrap('parse', parse_pages(opts, pages))
+        if cache:
+            parsed_items = []
+            items = keep_items(items, parsed_items)
+            # the messages are saved with the entry, to be shown on the next runs
+            messages = MessageLog()
+            logging.getLogger('trilhape').addHandler(messages)
+
+    try:
+        run_outputs(opts, items, outputs)
+    finally:
+        if cache and not cached:
+            logging.getLogger('trilhape').removeHandler(messages)
+
+    if cache and not cached:
+        # all items were consumed by the outputs
+        enduroape.perf.call('cache', cache.save, key, shown_pages, parsed_items, messages.messages)
+
+    return shown_pages
+
+BATCH_EXTENSIONS = ('.pdf', '.txt')
+
+# nomes das saídas do --batch, quando não especificados
+BATCH_DEFAULT_NAMES = {
+    'text': '%s.txt',
+    'html': '%s.html',
+}
+
+def find_sheets(dir, skip_dirs=()):
+    """Find the sheet files (PDF or text dumps) under 'dir'"""
+    skip = set(os.path.abspath(d) for d in skip_dirs)
+    r = []
+    for root,dirs,files in os.walk(dir):
+        dirs[:] = sorted(d for d in dirs if os.path.abspath(os.path.join(root, d)) not in skip)
+        for f in sorted(files):
+            if os.path.splitext(f)[1].lower() in BATCH_EXTENSIONS:
+                r.append(os.path.join(root, f))
+    return r
+
+def batch_outputs(outputs, out_dir, fname, base_dir=None):
+    """The outputs for one sheet of the batch
+
+    '%s' on the file names is replaced by the sheet name. Names without
+    '%s' get the sheet name as prefix. The subdirectories of the sheet
+    under 'base_dir' are kept under 'out_dir'.
+    """
+    name = os.path.splitext(os.path.basename(fname))[0]
+    if base_dir is not None:
+        subdir = os.path.relpath(os.path.dirname(os.path.abspath(fname)), os.path.abspath(base_dir))
+        if subdir != os.curdir:
+            out_dir = os.path.join(out_dir, subdir)
+    r = []
+    for kind,args,f in outputs:
+        if f == '-':
+            if kind == 'tmpl':
+                f = '%%s.%s' % (os.path.splitext(os.path.basename(args[0]))[0])
+            else:
+                f = BATCH_DEFAULT_NAMES[kind]
+        elif '%s' not in f:
+            f = '%s.' + f
+        r.append( (kind, args, os.path.join(out_dir, f.replace('%s', name))) )
+    return r
+
+def _batch_job(job):
+    opts,fname,outputs = job
+    start = time.time()
+    try:
+        process_sheet(opts, fname, outputs)
+        error = None
+    except Exception, e:
+        logger.debug('error on %s', fname, exc_info=True)
+        error = '%s: %s' % (e.__class__.__name__, e)
+    return fname, time.time()-start, error
+
+def run_batch(opts, outputs):
+    """Process all the sheets on opts.batch_dir, opts.jobs at a time
+
+    Errors on one sheet don't stop the others: they are reported at the
+    end, with the time spent on each file.
+    """
+    out_dir = opts.batch_out or os.path.join(opts.batch_dir, 'saida')
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+
+    # each file is processed by a single process
+    job_opts = copy.copy(opts)
+    job_opts.jobs = 1
+
+    files = find_sheets(opts.batch_dir, [out_dir])
+    jobs = []
+    failures = 0
+    targets = {}
+    for f in files:
+        outs = batch_outputs(outputs, out_dir, f, opts.batch_dir)
+        # e.g. 'etapa1.pdf' and its text dump 'etapa1.txt'
+        dup = [targets[o[2]] for o in outs if o[2] in targets]
+        if dup:
+            failures += 1
+            sys.stderr.write('%-50s %7.2fs ERRO: mesmas saídas que %s\n' % (f, 0, dup[0]))
+            continue
+        for o in outs:
+            targets[o[2]] = f
+            d = os.path.dirname(o[2])
+            if not os.path.isdir(d):
+                os.makedirs(d)
+        jobs.append( (job_opts, f, outs) )
+
+    if opts.jobs > 1:
+        pool = multiprocessing.Pool(opts.jobs)
+        results = pool.imap_unordered(_batch_job, jobs)
+    else:
+        pool = None
+        results = itertools.imap(_batch_job, jobs)
+
+    total = time.time()
+    for fname,elapsed,error in results:
+        if error:
+            failures += 1
+            sys.stderr.write('%-50s %7.2fs ERRO: %s\n' % (fname, elapsed, error))
+        else:
+            sys.stderr.write('%-50s %7.2fs ok\n' % (fname, elapsed))
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    sys.stderr.write('%d planilhas, %d com erro, %.2fs\n' % (len(files), failures, time.time()-total))
+    if failures:
+        return 1
 
 def main(argv):
     parser = optparse.OptionParser()
     parser.add_option('-P', help=u"Mostrar páginas originais da planilha", action='store_true', dest='show_pages')
     parser.add_option('-p', help=u"Calcular parciais", action='store_true', dest='parciais')
+    parser.add_option('--parciais-estrategia', help=u"Estratégia de posicionamento das parciais: %s" % (', '.join('%s (%s)' % (e.nome, e.descricao) for e in ESTRATEGIAS_PARCIAIS.values())), type='choice', choices=ESTRATEGIAS_PARCIAIS.keys(), action='store', dest='estrategia_parciais', default=ESTRATEGIA_PADRAO)
+    parser.add_option('--pdf-extractor', help=u"Extrator do texto do PDF: 'pdftotext' ou 'pdfminer' (sem subprocessos, precisa do pdfminer)", type='choice', choices=pdftext.EXTRACTORS.keys(), action='store', dest='pdf_extractor', default='pdftotext')
     parser.add_option('-D', help=u"Mostrar mensagens de debug", action='store_true', dest='debug')
+    parser.add_option('--trace-pages', help=u"Com -D, mostra as mensagens do parser só para essas páginas (ex.: 3,5-7)", metavar='PAGINAS', action='store', dest='trace_pages')
     parser.add_option('--html', help=u"Formata saída em HTML", action='store_true', dest='html')
     parser.add_option('-t', help=u"Usar arquivo de template Cheetah", action='store', dest='template_file')
+    parser.add_option('--template-cache', help=u"Diretório para guardar os templates compilados (padrão: %s; vazio para não guardar)" % (TEMPLATE_CACHE_DIR), metavar='DIR', action='store', dest='template_cache')
     parser.add_option('-v', help=u"Verbose mode", action='store_true', dest='verbose')
+    parser.add_option('--profile', help=u"Mostra o tempo, memória e número de itens de cada etapa", action='store_true', dest='profile')
+    parser.add_option('--profile-json', help=u"Grava os dados do --profile em JSON", metavar='ARQUIVO.JSON', action='store', dest='profile_json')
+    parser.add_option('--cprofile', help=u"Grava as estatísticas do cProfile de cada etapa em PREFIXO.ETAPA.prof", metavar='PREFIXO', action='store', dest='cprofile')
     parser.add_option('-S', help=u"Gerar arquivo de som", metavar='ARQUIVO.WAV', action='store', dest='soundfile')
+    parser.add_option('--out', help=u"Saída a gerar, pode ser repetida: text[:ARQUIVO], html[:ARQUIVO], tmpl:TEMPLATE[:ARQUIVO] ou sound:ARQUIVO.WAV", metavar='TIPO:ARGS', action='append', dest='outputs', default=[])
+    parser.add_option('--ticker', help=u"Acompanha a prova no terminal, com a largada em LARGADA (HH:MM[:SS] ou 'agora'). Tecle Enter ao passar por uma referência para ver o desvio, e 'q' para sair", metavar='LARGADA', action='store', dest='ticker')
+    parser.add_option('--cue-server', help=u"Transmite os avisos da prova pela rede para os aparelhos da equipe, com a largada em LARGADA (HH:MM[:SS] ou 'agora')", metavar='LARGADA', action='store', dest='cue_server')
+    parser.add_option('--cue-listen', help=u"Endereço do --cue-server (padrão: todas as interfaces, porta 7373)", metavar='[HOST:]PORTA', action='store', dest='cue_listen')
     parser.add_option('--no-silence', help=u"Gera audio sem trecho de silêncio, para teste", action='store_true', dest='no_silence')
     parser.add_option('-I', help=u"Diretório onde estão os sons das instruções da planilha", action='store', dest='instructions_dir')
+    parser.add_option('--audio-engine', help=u"Gerador de som: 'sox' ou 'native' (sem subprocessos do sox)", type='choice', choices=enduroape.sound.ENGINES.keys(), action='store', dest='audio_engine', default='sox')
+    parser.add_option('-j', '--jobs', help=u"Número de processos usados para gerar o som", type='int', action='store', dest='jobs', default=1)
+    parser.add_option('--sound-cache', help=u"Diretório para guardar os trechos de som já gerados, para reaproveitá-los", metavar='DIR', action='store', dest='sound_cache')
+    parser.add_option('--sound-cache-max-size', help=u"Tamanho máximo do cache de som, em MB (padrão: %d)" % (enduroape.sound.SEGMENT_CACHE_MAX_MB), type='int', action='store', dest='sound_cache_max_size', default=enduroape.sound.SEGMENT_CACHE_MAX_MB)
+    parser.add_option('--sound-cache-max-age', help=u"Idade máxima dos trechos no cache de som, em dias (padrão: %d)" % (enduroape.sound.SEGMENT_CACHE_MAX_DAYS), type='int', action='store', dest='sound_cache_max_age', default=enduroape.sound.SEGMENT_CACHE_MAX_DAYS)
+    parser.add_option('--timeline', help=u"Monta o som inteiro na memória e grava o WAV diretamente, sem sox", action='store_true', dest='timeline')
+    parser.add_option('--cache-dir', help=u"Diretório para guardar as planilhas já processadas, para não processá-las de novo", metavar='DIR', action='store', dest='cache_dir')
+    parser.add_option('--cache-max-size', help=u"Tamanho máximo do cache de planilhas, em MB (padrão: %d)" % (SHEET_CACHE_MAX_MB), type='int', action='store', dest='cache_max_size', default=SHEET_CACHE_MAX_MB)
+    parser.add_option('--batch', help=u"Processa todas as planilhas (PDF ou texto) do diretório. Nos arquivos do --out, '%s' é trocado pelo nome da planilha", metavar='DIR', action='store', dest='batch_dir')
+    parser.add_option('--batch-out', help=u"Diretório onde gravar as saídas do --batch, com os subdiretórios de DIR (padrão: DIR/saida)", metavar='DIR', action='store', dest='batch_out')
+    parser.add_option('--cache-max-age', help=u"Idade máxima das planilhas no cache, em dias (padrão: %d)" % (SHEET_CACHE_MAX_DAYS), type='int', action='store', dest='cache_max_age', default=SHEET_CACHE_MAX_DAYS)
 
     opts,args = parser.parse_args(argv)
 
-    if len(args) <> 1:
+    if opts.batch_dir:
+        if args:
+            parser.error("Não especifique arquivos junto com --batch")
+        if opts.show_pages:
+            parser.error("-P não pode ser usado com --batch")
+        if opts.profile or opts.profile_json or opts.cprofile:
+            parser.error("--profile não pode ser usado com --batch")
+        if opts.ticker or opts.cue_server:
+            parser.error("--ticker e --cue-server não podem ser usados com --batch")
+        fname = None
+    elif len(args) <> 1:
         parser.error("Especifique o caminho do arquivo PDF com a planilha")
-
-    fname = args[0]
+    else:
+        fname = args[0]
+
+    try:
+        outputs = [parse_output(o) for o in opts.outputs]
+    except ValueError, e:
+        parser.error(str(e))
+
+    if opts.ticker and opts.cue_server:
+        parser.error("--ticker não pode ser usado com --cue-server")
+    if opts.ticker or opts.cue_server:
+        if outputs:
+            parser.error("--ticker e --cue-server não podem ser usados com --out")
+        from enduroape import ticker
+        try:
+            start = ticker.parse_start(opts.ticker or opts.cue_server)
+        except ValueError, e:
+            parser.error(str(e))
+        if opts.ticker:
+            outputs = [('ticker', [start], '-')]
+        else:
+            from enduroape import cues
+            try:
+                address = cues.parse_address(opts.cue_listen or ':%d' % (cues.CUE_PORT))
+            except ValueError:
+                parser.error("endereço inválido: %r" % (opts.cue_listen))
+            try:
+                listener = cues.listen(address)
+            except socket.error, e:
+                parser.error("não foi possível escutar em %s:%d: %s" % (address[0] or '*', address[1], e.strerror or e))
+            outputs = [('cues', [start, listener], '-')]
+    elif not outputs:
+        if opts.soundfile:
+            outputs = [('sound', [], opts.soundfile)]
+        elif opts.html:
+            outputs = [('html', [], '-')]
+        elif opts.template_file:
+            outputs = [('tmpl', [opts.template_file], '-')]
+        else:
+            outputs = [('text', [], '-')]
 
     loglevel = logging.WARN
     if opts.debug:
@@ -980,43 +2113,38 @@ def main(argv):
         loglevel = logging.INFO
     logging.basicConfig(stream=sys.stderr, level=loglevel)
 
-    if mime_type(fname) == 'application/pdf':
-        proc = subprocess.Popen(['pdftotext', '-enc', 'UTF-8', '-layout', fname, '-'], stdout=subprocess.PIPE)
-        lines = proc.stdout.readlines()
-        proc.wait()
-        if proc.returncode <> 0:
-            raise Exception('pdftotext retornou erro!')
-    else:
-        lines = open(fname, 'r').readlines()
-
-    lines = [l.rstrip('\n') for l in lines]
-    lines = [unicode(l, 'utf-8') for l in lines]
-    groups = list(split_groups(lines))
+    trace_pages = None
+    if opts.trace_pages:
+        trace_pages = parse_page_list(opts.trace_pages)
+    set_trace(logger.isEnabledFor(logging.DEBUG), trace_pages)
 
-    dbg('%d groups found', len(groups))
-    for g in groups:
-        g.find_width()
-        g.find_page_limits()
+    if opts.template_cache is not None:
+        template_loader.cache_dir = opts.template_cache or None
 
-    pages = []
-    for g in groups:
-        for p in g.pages:
-            pages.append(p)
+    if opts.batch_dir:
+        return run_batch(opts, outputs)
 
-    items = list(parse_pages(opts, pages))
-
-    if opts.soundfile:
-        gen_sound(opts, items)
-    elif opts.html:
-        format_html(items)
-    elif opts.template_file:
-        format_template(opts, items)
-    else:
-        format_text(items)
+    prof = None
+    if opts.profile or opts.profile_json or opts.cprofile:
+        prof = enduroape.perf.current = enduroape.perf.Profiler(cprofile=bool(opts.cprofile))
 
+    shown_pages = process_sheet(opts, fname, outputs)
     if opts.show_pages:
-        for p in pages:
-            p.show(opts)
+        sink = OutputSink()
+        for p in shown_pages:
+            enduroape.perf.call('show_pages', p.show, opts, sink)
+        sink.flush()
+
+    if prof:
+        enduroape.perf.current = None
+        if opts.profile:
+            prof.report(sys.stderr)
+        if opts.profile_json:
+            f = open(opts.profile_json, 'w')
+            json.dump(prof.as_dict(), f, indent=2)
+            f.close()
+        if opts.cprofile:
+            prof.dump_cprofile(opts.cprofile)
 
 
 
@@ -1,4 +1,4 @@
 #!/usr/bin/env python
 import sys
 import enduroape.trilhape.planilha
-enduroape.trilhape.planilha.main(sys.argv[1:])
+sys.exit(enduroape.trilhape.planilha.main(sys.argv[1:]))